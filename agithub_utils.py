@@ -0,0 +1,394 @@
+"""
+    agithub utility functions shared by the scripts
+"""
+import concurrent.futures
+import copy
+import gzip
+import http.client
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from agithub.GitHub import GitHub, GitHubClient
+
+# largest page size GitHub allows
+MAX_PER_PAGE = 100
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitGovernor:
+    """
+    Pace API calls to stay within GitHub's rate limits
+
+    Every response carries X-RateLimit-* headers for the bucket ("core",
+    "search", "code_search", "graphql", ...) it was charged to. Those are
+    tracked per bucket, and each call first takes a token from its bucket.
+    After an initial burst, tokens refill at the rate that spreads the
+    remaining calls evenly until the bucket resets. Once a bucket is down to
+    its reserve, callers sleep until it resets. Calls which GitHub doesn't
+    count (a 304 Not Modified) give their token back.
+
+    If a response was charged to a different bucket than the caller
+    expected, later calls expecting that bucket use the one GitHub named.
+
+    No extra calls are made to learn the budget, and one governor is safely
+    shared by all threads.
+    """
+
+    def __init__(self, burst_fraction=0.5, reserves=None):
+        self.burst_fraction = burst_fraction
+        # calls to leave unused in each bucket
+        self.reserves = {"core": 25}
+        self.reserves.update(reserves or {})
+        self.lock = threading.Lock()
+        self.buckets = {}
+        # bucket GitHub actually charges, by the one callers expect
+        self.aliases = {}
+
+    def update(self, headers, expected=None):
+        """
+        Record the rate limit headers of a response
+
+        expected is the bucket the call was paced against.
+        """
+        h = {k.lower(): v for k, v in headers or []}
+        try:
+            limit = int(h["x-ratelimit-limit"])
+            remaining = int(h["x-ratelimit-remaining"])
+            reset = int(h["x-ratelimit-reset"])
+        except (KeyError, ValueError):
+            return
+        resource = h.get("x-ratelimit-resource", "core")
+        with self.lock:
+            if expected and self.aliases.get(expected, expected) != resource:
+                logger.debug("%s calls are charged to %s", expected, resource)
+                self.aliases[expected] = resource
+            bucket = self.buckets.get(resource)
+            if bucket is None or bucket["reset"] != reset:
+                # a new window, start with a full burst
+                bucket = {
+                    "limit": limit,
+                    "reset": reset,
+                    "tokens": max(1, limit * self.burst_fraction),
+                    "last_time": time.time(),
+                }
+                self.buckets[resource] = bucket
+            bucket["remaining"] = remaining
+
+    def remaining(self, resource="core"):
+        """
+        Calls left in resource's bucket, or None if not yet known
+        """
+        with self.lock:
+            resource = self.aliases.get(resource, resource)
+            return self.buckets.get(resource, {}).get("remaining")
+
+    def acquire(self, resource="core"):
+        """
+        Wait until a call may be made against resource's bucket
+        """
+        while True:
+            nap, exhausted = self._reserve(resource)
+            if nap > 1:
+                logger.info("napping for %d seconds on %s rate limit", nap, resource)
+            if nap > 0:
+                time.sleep(nap)
+            if not exhausted:
+                return
+            # slept until the reset, so try again
+
+    def refund(self, resource="core"):
+        """
+        Give back the token of a call GitHub didn't count
+        """
+        with self.lock:
+            bucket = self.buckets.get(self.aliases.get(resource, resource))
+            if bucket is not None:
+                burst = max(1, bucket["limit"] * self.burst_fraction)
+                bucket["tokens"] = min(burst, bucket["tokens"] + 1)
+
+    def _reserve(self, resource):
+        """
+        Take a token, returning (seconds to wait, bucket exhausted)
+        """
+        with self.lock:
+            resource = self.aliases.get(resource, resource)
+            bucket = self.buckets.get(resource)
+            now = time.time()
+            if bucket is None:
+                # nothing known yet, the response will tell us
+                return 0, False
+            if now >= bucket["reset"]:
+                # window is over, wait to hear about the new one
+                del self.buckets[resource]
+                return 0, False
+            budget = bucket["remaining"] - self.reserves.get(resource, 1)
+            if budget <= 0:
+                return bucket["reset"] - now + 1, True
+            rate = budget / max(bucket["reset"] - now, 1)
+            burst = max(1, bucket["limit"] * self.burst_fraction)
+            elapsed = now - bucket["last_time"]
+            bucket["tokens"] = min(burst, bucket["tokens"] + elapsed * rate)
+            bucket["last_time"] = now
+            # count the call now, the response will correct the count
+            bucket["tokens"] -= 1
+            bucket["remaining"] -= 1
+            nap = -bucket["tokens"] / rate if bucket["tokens"] < 0 else 0
+            return nap, False
+
+
+# shared by all clients (and threads) in the process
+governor = RateLimitGovernor()
+
+
+def rate_limit_resource(url):
+    """
+    Name of the rate limit bucket a call to url is charged to
+    """
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith("/search/code"):
+        return "code_search"
+    elif path.startswith("/search/"):
+        return "search"
+    elif path.startswith("/graphql"):
+        return "graphql"
+    return "core"
+
+
+class PooledResponse:
+    """
+    A fully read (and decompressed) response
+
+    Has the parts of http.client.HTTPResponse that agithub uses.
+    """
+
+    def __init__(self, response):
+        self.status = response.status
+        self.headers = response.getheaders()
+        body = response.read()
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            body = gzip.decompress(body)
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        for k, v in self.headers:
+            if k.lower() == name.lower():
+                return v
+        return default
+
+    def getheaders(self):
+        return self.headers
+
+
+class PooledConnection:
+    """
+    Connection handed out by a ConnectionPool
+
+    Used by agithub like an http.client connection, but close() returns the
+    connection to the pool, unless the server ended the keep-alive.
+    """
+
+    def __init__(self, pool, conn, reused):
+        self.pool = pool
+        self.conn = conn
+        self.reused = reused
+        self.keep = False
+        self._request = None
+
+    def request(self, method, url, body=None, headers=None):
+        # sent from getresponse(), so it can be resent on a stale connection
+        self._request = (method, url, body, headers or {})
+
+    def getresponse(self):
+        try:
+            response = self._exchange()
+        except (http.client.HTTPException, ConnectionError):
+            if not self.reused:
+                raise
+            # the server closed the idle connection, so try a new one
+            logger.debug("Reconnecting stale connection to %s", self.conn.host)
+            self.conn.close()
+            self.conn = self.pool.new_connection()
+            self.reused = False
+            response = self._exchange()
+        return response
+
+    def _exchange(self):
+        self.conn.request(*self._request)
+        response = self.conn.getresponse()
+        self.keep = not response.will_close
+        return PooledResponse(response)
+
+    def close(self):
+        if self.keep:
+            self.pool.put(self.conn)
+        else:
+            self.conn.close()
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections to a server, shared by all threads
+
+    Each thread takes an idle connection for the length of a request, so
+    connection (and TLS) setup is only paid when all are busy.
+    """
+
+    def __init__(self, connect, max_idle=16):
+        self.connect = connect
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        return self.connect()
+
+    def get(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            return PooledConnection(self, self.new_connection(), reused=False)
+        return PooledConnection(self, conn, reused=True)
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+
+class ThreadLocalGitHubClient(GitHubClient):
+    """
+    GitHubClient which keeps the last response headers per thread
+
+    agithub stores the headers of the last response on the client, which is
+    shared by all threads. Keeping them thread local lets callers (and
+    agithub's own rate limit sleeping) see the headers of the response they
+    actually received.
+
+    Requests also go over pooled keep-alive connections, and ask for gzip
+    compressed responses.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def headers(self):
+        return getattr(self._local, "headers", None)
+
+    @headers.setter
+    def headers(self, value):
+        self._local.headers = value
+
+    def get_connection(self):
+        # pool per server, in case the connection properties are changed
+        key = (self.prop.secure_http, self.prop.api_url)
+        with self._pools_lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(super().get_connection)
+                self._pools[key] = pool
+        return pool.get()
+
+    def request(self, method, url, bodyData, headers):
+        # checking the rate limit is free, everything else is paced
+        resource = None
+        if urllib.parse.urlsplit(url).path != "/rate_limit":
+            resource = rate_limit_resource(url)
+            governor.acquire(resource)
+        if "accept-encoding" not in (k.lower() for k in headers):
+            headers = dict(headers, **{"accept-encoding": "gzip"})
+        response = super().request(method, url, bodyData, headers)
+        governor.update(self.headers, resource)
+        if resource and response[0] == 304:
+            # conditional requests that match cost nothing
+            governor.refund(resource)
+        return response
+
+
+def get_github_client(credentials_file=".credentials"):
+    def get_token():
+        token = ""
+        with open(credentials_file, "r") as cf:
+            cf.readline()  # skip first line
+            token = cf.readline().strip()
+        return token
+
+    token = get_token()
+    #  gh = github3.login(token=token)
+    gh = GitHub(token=token)
+    gh.generateAuthHeader()
+    # swap in a client that is safe to share across threads
+    connection_properties = gh.client.prop
+    api_url = os.environ.get("GITHUB_API_URL")
+    if api_url:
+        # e.g. a fake_github.py server
+        parts = urllib.parse.urlsplit(api_url)
+        connection_properties.api_url = parts.netloc
+        connection_properties.secure_http = parts.scheme != "http"
+        if not connection_properties.secure_http:
+            # agithub won't send the token unencrypted, a fake needs none
+            connection_properties.extra_headers.pop("authorization", None)
+    gh.setClient(ThreadLocalGitHubClient())
+    gh.setConnectionProperties(connection_properties)
+    return gh
+
+
+def ag_get_all(call, func, *orig_args, **orig_kwargs):
+    """
+    Generator for multi-page GitHub responses
+
+    Each page is requested via call(func, ...), normally the calling
+    script's ag_call. Pages are requested at the maximum size, and the
+    "next" link of each response is followed, so no request is spent on a
+    trailing empty page. The next page is fetched while the caller is still
+    working on the current one.
+
+    List responses are yielded an element at a time, anything else (such as
+    a page of search results) a page at a time.
+    """
+    kwargs = copy.deepcopy(orig_kwargs)
+    args = copy.deepcopy(orig_args)
+    kwargs.setdefault("per_page", MAX_PER_PAGE)
+    # the agithub client the request method is bound to
+    client = func.func.__self__
+
+    def fetch_page(kwargs):
+        body = call(func, *args, **kwargs)
+        # must be read in the same thread as the call was made
+        return body, client.get_next_link_url()
+
+    prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        pending = prefetcher.submit(fetch_page, kwargs)
+        while pending:
+            body, next_url = pending.result()
+            pending = None
+            if next_url:
+                # fix up to get next page, without changing query set
+                kwargs = dict(kwargs, new_only=False)
+                query = urllib.parse.urlsplit(next_url).query
+                kwargs.update(urllib.parse.parse_qsl(query))
+                pending = prefetcher.submit(fetch_page, kwargs)
+            # search results are ugly
+            if isinstance(body, dict) and "items" in body and len(body["items"]) == 0:
+                break
+            elif not isinstance(body, list):
+                yield body
+            else:
+                for elem in body:
+                    yield elem
+    finally:
+        # caller may stop early, don't wait on an unwanted page
+        prefetcher.shutdown(wait=False)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+    Compare request latency of the plain agithub client with the pooled one
+"""
+import argparse
+import logging
+import ssl
+import statistics
+import threading
+import time
+
+from agithub.base import ConnectionProperties
+from agithub.GitHub import GitHub, GitHubClient
+
+import agithub_utils
+import fake_github
+
+help_epilog = """
+A fake_github.py server on 127.0.0.1 serves a repo document and a listing
+of 200 hooks (about 33KB of json, like a real hooks listing). Each is
+requested '--requests' times in a row by a plain agithub client, and by
+the client get_github_client makes (pooled keep-alive connections, gzip),
+and the per request latency and size on the wire are shown.
+
+With '--tls', the server uses that certificate & key (e.g. made with
+'openssl req -x509 -newkey rsa:2048 -nodes -subj /CN=localhost ...'), and
+the clients don't verify it.
+"""
+
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+CLIENTS = (("agithub", GitHubClient), ("pooled", agithub_utils.ThreadLocalGitHubClient))
+
+
+def recorded_responses():
+    hook = {
+        "type": "Repository",
+        "name": "web",
+        "active": True,
+        "events": ["push", "pull_request"],
+        "config": {"content_type": "json", "insecure_ssl": "0"},
+        "updated_at": "2020-01-01T00:00:00Z",
+        "created_at": "2020-01-01T00:00:00Z",
+    }
+    hooks = [
+        dict(hook, id=i, url=f"https://api.github.com/repos/bench/repo/hooks/{i}")
+        for i in range(200)
+    ]
+    for h in hooks:
+        h["config"] = dict(h["config"], url=f"https://example.com/hook/{h['id']}")
+    return {
+        "GET /repos/bench/repo": {
+            "id": 1,
+            "name": "repo",
+            "full_name": "bench/repo",
+            "owner": {"login": "bench"},
+            "default_branch": "main",
+        },
+        # all in one page
+        "GET /repos/bench/repo/hooks": hooks,
+    }
+
+
+def client(client_class, port, tls):
+    gh = GitHub()
+    gh.setClient(client_class())
+    gh.setConnectionProperties(
+        ConnectionProperties(
+            api_url=f"127.0.0.1:{port}",
+            secure_http=tls,
+            extra_headers={"accept": "application/vnd.github.v3+json"},
+        )
+    )
+    return gh
+
+
+def time_requests(method, count):
+    """
+    List of the seconds each of count calls of method took
+    """
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        rc, _ = method(per_page=agithub_utils.MAX_PER_PAGE)
+        latencies.append(time.perf_counter() - start)
+        if rc != 200:
+            raise ValueError(f"Got {rc}")
+    return latencies
+
+
+def main(driver=None):
+    args = parse_args()
+    server = fake_github.make_server(recorded_responses(), bind="127.0.0.1")
+    if args.tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*args.tls)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        # the clients use the default context, which would reject it
+        ssl._create_default_https_context = ssl._create_unverified_context
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # measure the transport, not the pacing
+    agithub_utils.governor.acquire = lambda resource="core": None
+    scheme = "https" if args.tls else "http"
+    print(f"{args.requests} sequential GETs each over {scheme}")
+    print(f"{'':14} {'client':8} {'median':>9} {'mean':>9} {'bytes':>7}")
+    for path in ("repos/bench/repo", "repos/bench/repo/hooks"):
+        for name, client_class in CLIENTS:
+            gh = client(client_class, server.server_port, bool(args.tls))
+            method = gh
+            for segment in path.split("/"):
+                method = method[segment]
+            # first request connects, as any run has to
+            method.get()
+            latencies = time_requests(method.get, args.requests)
+            headers = {k.lower(): v for k, v in gh.getheaders()}
+            print(
+                "{:14} {:8} {:6.2f} ms {:6.2f} ms {:>7}".format(
+                    path.split("/")[-1],
+                    name,
+                    statistics.median(latencies) * 1000,
+                    statistics.mean(latencies) * 1000,
+                    headers.get("content-length", "?"),
+                )
+            )
+    server.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=help_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    parser.add_argument(
+        "--requests",
+        help="requests per document and client (default 300)",
+        type=int,
+        default=300,
+    )
+    parser.add_argument(
+        "--tls", help="serve https with this certificate & key", nargs=2
+    )
+    args = parser.parse_args()
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+    Search for a term in local clones of the repos GitHub finds it in
+"""
+import argparse
+import concurrent.futures
+import getpass
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+
+import agithub_utils
+import db_store
+import term_search
+
+help_epilog = """
+Repos are found with GitHub's code search (as term_search.py does), then
+cloned (shallow) into '--workdir', or brought up to date if already there.
+Each repo is searched with 'rg' as soon as its checkout is ready, while
+other repos are still being fetched.
+
+An existing clone is only fetched if the repo was pushed to since it was
+last synced. When pushed to is taken from the '{owner}.db.json' files in
+'--db-dir' if given, otherwise asked of GitHub (with a conditional request,
+which is free when nothing changed). The search results of each clone are
+kept until it changes, so searching an unchanged clone for the same term
+again doesn't run 'rg'. Without 'rg' installed, 'grep' is used instead,
+which shows no context and doesn't take '--grep-opts'.
+
+Output is each match as 'owner/repo:path:line:text', or with '--json' a
+json object per match, with keys repo, path, line and match.
+"""
+
+DEBUG = False
+CREDENTIALS_FILE = ".credentials"
+logger = logging.getLogger(__name__)
+
+# notes kept in each clone's .git directory
+SYNC_STATE = "audit-sync.json"
+GREP_CACHE = "audit-grep.json"
+# searches to remember per clone
+GREP_CACHE_SIZE = 32
+
+# same clone cache as show_all_terms has always used
+DEFAULT_WORKDIR = os.environ.get(
+    "WORKDIR", "/tmp/{}-show_all_terms".format(getpass.getuser())
+)
+
+
+def run_git(*args, cwd=None):
+    result = subprocess.run(
+        ("git",) + args,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode:
+        logger.error("git {} failed: {}".format(args[0], result.stderr.strip()))
+    return result.returncode == 0
+
+
+def head_commit(path):
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def repo_dir(workdir, full_name):
+    owner, repo = full_name.split("/")
+    return os.path.join(workdir, owner, repo)
+
+
+def read_state(path, name):
+    """
+    Our notes about the clone in path, stored in its .git directory
+    """
+    try:
+        with open(os.path.join(path, ".git", name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(path, name, state):
+    state_file = os.path.join(path, ".git", name)
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+class DbRepoActivity:
+    """
+    When repos were last pushed to, from the dbs of get_branch_protections.py
+    """
+
+    repo_pat = re.compile(r"^/repos/[^/]+/[^/]+$")
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.orgs = {}
+        self.lock = threading.Lock()
+
+    def load(self, owner):
+        pushed = {}
+        for storage_class in db_store.STORAGE_CLASSES.values():
+            db_file = os.path.join(self.db_dir, owner + storage_class.suffix)
+            if not os.path.isfile(db_file):
+                continue
+            if storage_class is db_store.SqliteStore:
+                store = db_store.SqliteStore(db_file)
+                try:
+                    documents = list(store.documents())
+                finally:
+                    store.close()
+            else:
+                with open(db_file) as infile:
+                    documents = list(db_store.iter_json_documents(infile))
+            for doc in documents:
+                if self.repo_pat.match(doc.get("url", "")):
+                    # '/repos/{owner}/{repo}'
+                    full_name = doc["url"].split("/", 2)[2].lower()
+                    pushed[full_name] = (doc.get("body") or {}).get("pushed_at")
+            break
+        return pushed
+
+    def pushed_at(self, full_name, state):
+        owner = full_name.split("/")[0]
+        with self.lock:
+            if owner not in self.orgs:
+                self.orgs[owner] = self.load(owner)
+        return self.orgs[owner].get(full_name.lower())
+
+
+class ApiRepoActivity:
+    """
+    When repos were last pushed to, from (conditional) GitHub requests
+    """
+
+    def __init__(self, gh):
+        self.gh = gh
+
+    def pushed_at(self, full_name, state):
+        owner, repo = full_name.split("/")
+        headers = {"If-None-Match": state["etag"]} if state.get("etag") else {}
+        try:
+            rc, body = term_search.ag_call_with_rc(
+                self.gh.repos[owner][repo].get, headers=headers
+            )
+        except term_search.AG_Exception:
+            # already logged, fetch the clone as if pushed to
+            return None
+        if rc == 304:
+            return state.get("pushed_at")
+        elif rc != 200:
+            # 403 or 404, already logged
+            return None
+        h = {k.lower(): v for k, v in self.gh.getheaders()}
+        state["etag"] = h.get("etag")
+        return body.get("pushed_at")
+
+
+def sync_repo(workdir, full_name, activity=None):
+    """
+    Clone full_name into workdir, or update the existing clone
+
+    With activity, an existing clone is only fetched if the repo was pushed
+    to since the last sync.
+
+    returns the checkout directory, None if it couldn't be synced
+    """
+    path = repo_dir(workdir, full_name)
+    state = read_state(path, SYNC_STATE)
+    pushed_at = activity.pushed_at(full_name, state) if activity else None
+    if os.path.isdir(os.path.join(path, ".git")):
+        if (
+            pushed_at is not None
+            and pushed_at == state.get("pushed_at")
+            and state.get("sha") == head_commit(path)
+        ):
+            logger.debug("{} unchanged since {}".format(full_name, pushed_at))
+            return path
+        ok = run_git("fetch", "--depth", "1", "origin", "HEAD", cwd=path) and run_git(
+            "reset", "--hard", "FETCH_HEAD", cwd=path
+        )
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        url = "https://github.com/{}".format(full_name)
+        ok = run_git("clone", "--quiet", "--depth", "1", url, path)
+    if not ok:
+        return None
+    state.update({"pushed_at": pushed_at, "sha": head_commit(path)})
+    write_state(path, SYNC_STATE, state)
+    return path
+
+
+def grep_repo(path, term, grep_opts=()):
+    """
+    Search a checkout for term
+
+    returns list of (path, line number, text, is match), context lines
+    (from grep_opts) have is match False
+    """
+    rg = shutil.which("rg")
+    if rg is None and grep_opts:
+        raise ValueError("grep_opts are rg options, and rg isn't installed")
+    if rg is None:
+        # plain grep, without context, paths end with a NUL as they may
+        # contain ':'
+        cmd = ["grep", "-rnIHZ", "--exclude-dir=.git", "-e", term, "."]
+    else:
+        cmd = [rg, "--json"] + list(grep_opts) + ["-e", term, "."]
+    result = subprocess.run(
+        cmd, cwd=path, stdout=subprocess.PIPE, universal_newlines=True
+    )
+    hits = []
+    for line in result.stdout.splitlines():
+        if rg is None:
+            file_name, _, rest = line.partition("\0")
+            line_number, _, text = rest.partition(":")
+            hits.append((file_name, int(line_number), text, True))
+            continue
+        message = json.loads(line)
+        if message["type"] not in ("match", "context"):
+            continue
+        data = message["data"]
+        hits.append(
+            (
+                data["path"].get("text", ""),
+                data["line_number"],
+                data["lines"].get("text", "").rstrip("\n"),
+                message["type"] == "match",
+            )
+        )
+    return hits
+
+
+def cached_grep(path, term, grep_opts=()):
+    """
+    grep_repo, reusing the results of the same search of the same commit
+    """
+    sha = head_commit(path)
+    cache = read_state(path, GREP_CACHE)
+    if cache.get("sha") != sha:
+        cache = {"sha": sha, "results": {}}
+    key = json.dumps([term, list(grep_opts), shutil.which("rg") is not None])
+    hits = cache["results"].pop(key, None)
+    if hits is None:
+        hits = grep_repo(path, term, grep_opts)
+    # most recently used last, so the oldest are dropped
+    cache["results"][key] = hits
+    for old_key in list(cache["results"])[:-GREP_CACHE_SIZE]:
+        del cache["results"][old_key]
+    write_state(path, GREP_CACHE, cache)
+    return [tuple(hit) for hit in hits]
+
+
+def search_repos(repos, term, workdir, jobs=8, grep_opts=(), sync=True, activity=None):
+    """
+    Generator of (repo, grep_repo hits) for each repo, as they finish
+
+    Repos are synced by a pool of jobs workers, and each is grepped (in a
+    pool sized for the cpus) once its checkout is ready. repos may be a
+    generator, the first repos are synced while it is producing the rest.
+
+    Without sync, the clones are searched as they are, so may have been
+    changed since they were synced, and earlier results aren't used.
+    """
+    syncer = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    grepper = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+    # (repo, hits), hits None if the repo couldn't be searched
+    results = queue.Queue()
+
+    def grep(repo, path):
+        try:
+            search = cached_grep if sync else grep_repo
+            results.put((repo, search(path, term, grep_opts)))
+        except Exception:
+            logger.exception("Can't search {}".format(repo))
+            results.put((repo, None))
+
+    def sync_then_grep(repo):
+        try:
+            if sync:
+                path = sync_repo(workdir, repo, activity)
+            else:
+                path = repo_dir(workdir, repo)
+        except Exception:
+            logger.exception("Can't sync {}".format(repo))
+            path = None
+        if path is None or not os.path.isdir(path):
+            logger.warning("Skipping {}, no clone".format(repo))
+            results.put((repo, None))
+        else:
+            grepper.submit(grep, repo, path)
+
+    submitted = finished = 0
+    try:
+        for repo in repos:
+            syncer.submit(sync_then_grep, repo)
+            submitted += 1
+            while not results.empty():
+                finished += 1
+                repo, hits = results.get()
+                if hits is not None:
+                    yield repo, hits
+        while finished < submitted:
+            finished += 1
+            repo, hits = results.get()
+            if hits is not None:
+                yield repo, hits
+    finally:
+        syncer.shutdown(wait=False)
+        grepper.shutdown(wait=False)
+
+
+def found_repos(scopes, term):
+    """
+    Generator for the repos GitHub's code search finds term in
+    """
+    for scope in scopes:
+        logger.info("Searching {}".format(scope))
+        for repo in term_search.matching_repos(scope, term):
+            yield repo
+
+
+def main(driver=None):
+    args = parse_args()
+    activity = None
+    if args.db_dir:
+        activity = DbRepoActivity(args.db_dir)
+    if args.no_search or args.list_only:
+        repos = args.scopes
+    else:
+        term_search.gh = agithub_utils.get_github_client(CREDENTIALS_FILE)
+        activity = activity or ApiRepoActivity(term_search.gh)
+        repos = found_repos(args.scopes, args.term)
+    results = search_repos(
+        repos,
+        args.term,
+        args.workdir,
+        jobs=args.jobs,
+        grep_opts=args.grep_opts.split(),
+        sync=not args.list_only,
+        activity=activity,
+    )
+    for repo, hits in results:
+        for path, line, text, is_match in hits:
+            path = os.path.normpath(path)
+            if args.json:
+                if is_match:
+                    print(
+                        json.dumps(
+                            {"repo": repo, "path": path, "line": line, "match": text}
+                        )
+                    )
+            else:
+                separator = ":" if is_match else "-"
+                print(separator.join((repo, path, str(line), text)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=help_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    parser.add_argument("term", help="Term (regular expression) to search for")
+    parser.add_argument(
+        "scopes", help="User or User/Repo (just User/Repo without search)", nargs="+"
+    )
+    parser.add_argument(
+        "--workdir",
+        help="directory to put repos in (default {})".format(DEFAULT_WORKDIR),
+        default=DEFAULT_WORKDIR,
+    )
+    parser.add_argument(
+        "--jobs",
+        help="repos to clone or fetch at once (default 8)",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--grep-opts", help="extra options for rg, such as '-A 1'", default=""
+    )
+    parser.add_argument(
+        "--no-search", help="skip GitHub search, scopes are repos", action="store_true"
+    )
+    parser.add_argument(
+        "--list-only",
+        help="skip GitHub search & clone, just search existing clones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--db-dir", help="directory with the '{owner}.db.json' files, if any"
+    )
+    parser.add_argument("--json", help="output json lines", action="store_true")
+    args = parser.parse_args()
+    if args.grep_opts and shutil.which("rg") is None:
+        parser.error("--grep-opts needs rg, which isn't installed")
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+    Trigram index of the clones made by clone_search.py, for offline search
+"""
+import argparse
+import array
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import time
+
+import clone_search
+
+help_epilog = """
+Subcommands:
+    update  index the clones in '--workdir' (all of them, or just the repos
+            given) which changed since they were last indexed
+    search  show the lines containing a term, in all indexed repos (or just
+            the repos given)
+
+Each repo is indexed as of its checked out commit, and only indexed again
+once that changes. A search only reads the files which contain every
+trigram (3 byte sequence) of the term, so no GitHub search is needed.
+
+Output is as for clone_search.py.
+"""
+
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+# files bigger than this, or with a NUL byte near the start, aren't indexed
+MAX_FILE_SIZE = 1024 * 1024
+BINARY_CHECK_SIZE = 8 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    commit_sha TEXT NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    repo TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (repo, file_id)
+);
+CREATE TABLE IF NOT EXISTS postings (
+    trigram BLOB NOT NULL,
+    repo TEXT NOT NULL,
+    file_ids BLOB NOT NULL,
+    PRIMARY KEY (trigram, repo)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_repo ON postings (repo);
+"""
+
+
+def open_index(filename):
+    conn = sqlite3.connect(filename)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def trigrams(data):
+    """
+    Set of the (lower case) trigrams of data (bytes)
+    """
+    data = data.lower()
+    return {data[i : i + 3] for i in range(len(data) - 2)}  # noqa: E203
+
+
+def tracked_files(path):
+    result = subprocess.run(
+        ["git", "ls-files", "-z"], cwd=path, stdout=subprocess.PIPE, check=True
+    )
+    return [name for name in result.stdout.decode().split("\0") if name]
+
+
+def index_checkout(path):
+    """
+    Trigram postings of the files of a checkout
+
+    returns ([file path, ...], {trigram: array of file ids})
+    """
+    paths = []
+    postings = {}
+    for name in tracked_files(path):
+        file_name = os.path.join(path, name)
+        try:
+            if not os.path.isfile(file_name):
+                continue
+            if os.path.getsize(file_name) > MAX_FILE_SIZE:
+                continue
+            with open(file_name, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            logger.debug("Skipping {}: {}".format(file_name, e))
+            continue
+        if b"\0" in data[:BINARY_CHECK_SIZE]:
+            continue
+        file_id = len(paths)
+        paths.append(name)
+        for trigram in trigrams(data):
+            postings.setdefault(trigram, array.array("I")).append(file_id)
+    return paths, postings
+
+
+def indexed_commits(conn):
+    return dict(conn.execute("SELECT repo, commit_sha FROM repos"))
+
+
+def store_repo(conn, repo, commit_sha, paths, postings):
+    """
+    Replace the index of repo, or drop it if commit_sha is None
+    """
+    with conn:
+        for table in ("repos", "files", "postings"):
+            conn.execute("DELETE FROM {} WHERE repo = ?".format(table), (repo,))
+        conn.executemany(
+            "INSERT INTO files VALUES (?, ?, ?)",
+            ((repo, file_id, path) for file_id, path in enumerate(paths)),
+        )
+        conn.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?)",
+            # in key order, which is quicker to insert
+            (
+                (trigram, repo, postings[trigram].tobytes())
+                for trigram in sorted(postings)
+            ),
+        )
+        if commit_sha is not None:
+            conn.execute(
+                "INSERT INTO repos VALUES (?, ?, ?)", (repo, commit_sha, time.time())
+            )
+
+
+def checkouts(workdir, repos=None):
+    """
+    Generator of (owner/repo, path) for each clone in workdir
+    """
+    if repos is None:
+        repos = []
+        for owner in sorted(os.listdir(workdir)):
+            if os.path.isdir(os.path.join(workdir, owner)):
+                for name in sorted(os.listdir(os.path.join(workdir, owner))):
+                    repos.append("{}/{}".format(owner, name))
+    for repo in repos:
+        path = clone_search.repo_dir(workdir, repo)
+        if os.path.isdir(os.path.join(path, ".git")):
+            yield repo, path
+        else:
+            logger.warning("No clone of {}".format(repo))
+
+
+def update_index(conn, workdir, repos=None, jobs=None):
+    """
+    Index the clones whose checked out commit isn't the indexed one
+
+    returns the number of repos indexed
+    """
+    known = indexed_commits(conn)
+    stale = {}
+    present = set()
+    for repo, path in checkouts(workdir, repos):
+        present.add(repo)
+        commit_sha = clone_search.head_commit(path)
+        if commit_sha is None:
+            logger.warning("No commit checked out in {}".format(path))
+        elif known.get(repo) != commit_sha:
+            stale[repo] = (path, commit_sha)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(index_checkout, path): repo for repo, (path, _) in stale.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            repo = futures[future]
+            paths, postings = future.result()
+            store_repo(conn, repo, stale[repo][1], paths, postings)
+            logger.debug("Indexed {} files of {}".format(len(paths), repo))
+    if repos is None:
+        # clones removed from workdir
+        for repo in set(known) - present:
+            logger.info("Dropping {} from the index".format(repo))
+            store_repo(conn, repo, None, [], {})
+    return len(stale)
+
+
+def candidate_files(conn, term, repos=None):
+    """
+    {repo: [path, ...]} of the indexed files which may contain term
+    """
+    if repos:
+        candidates = {repo: None for repo in repos}
+    else:
+        candidates = {repo: None for repo in indexed_commits(conn)}
+    for trigram in trigrams(term.encode()):
+        found = {}
+        for repo, file_ids in conn.execute(
+            "SELECT repo, file_ids FROM postings WHERE trigram = ?", (trigram,)
+        ):
+            if repo not in candidates:
+                continue
+            ids = array.array("I")
+            ids.frombytes(file_ids)
+            if candidates[repo] is None:
+                found[repo] = set(ids)
+            else:
+                found[repo] = candidates[repo].intersection(ids)
+        # a repo without the trigram can't contain the term
+        candidates = {repo: ids for repo, ids in found.items() if ids}
+        if not candidates:
+            break
+    result = {}
+    for repo, ids in candidates.items():
+        # ids is None if the term is too short to have any trigrams
+        result[repo] = [
+            path
+            for file_id, path in conn.execute(
+                "SELECT file_id, path FROM files WHERE repo = ? ORDER BY file_id",
+                (repo,),
+            )
+            if ids is None or file_id in ids
+        ]
+    return result
+
+
+def search_files(workdir, repo, paths, term, ignore_case=False):
+    """
+    Generator of (path, line number, text) for each line containing term
+    """
+    needle = term.lower() if ignore_case else term
+    checkout = clone_search.repo_dir(workdir, repo)
+    for path in paths:
+        try:
+            with open(os.path.join(checkout, path), errors="replace") as f:
+                for line_number, line in enumerate(f, 1):
+                    if needle in (line.lower() if ignore_case else line):
+                        yield path, line_number, line.rstrip("\n")
+        except OSError as e:
+            logger.warning("Can't read {} of {}: {}".format(path, repo, e))
+
+
+def update_main(args):
+    conn = open_index(args.index)
+    count = update_index(conn, args.workdir, args.repos or None, args.jobs)
+    logger.info("Indexed {} repos".format(count))
+
+
+def search_main(args):
+    conn = open_index(args.index)
+    candidates = candidate_files(conn, args.term, args.repos)
+    for repo, paths in sorted(candidates.items()):
+        for path, line, text in search_files(
+            args.workdir, repo, paths, args.term, args.ignore_case
+        ):
+            if args.json:
+                match = {"repo": repo, "path": path, "line": line, "match": text}
+                print(json.dumps(match))
+            else:
+                print(":".join((repo, path, str(line), text)))
+
+
+def main(driver=None):
+    args = parse_args()
+    return args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=help_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    parser.add_argument(
+        "--workdir",
+        help="directory with the clones (default {})".format(
+            clone_search.DEFAULT_WORKDIR
+        ),
+        default=clone_search.DEFAULT_WORKDIR,
+    )
+    parser.add_argument(
+        "--index", help="index file (default '{workdir}/code_index.sqlite')"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    update_parser = subparsers.add_parser("update", help="index changed clones")
+    update_parser.add_argument("repos", help="owner/repo to index", nargs="*")
+    update_parser.add_argument(
+        "--jobs", help="repos to index in parallel (default #cpus)", type=int
+    )
+    update_parser.set_defaults(func=update_main)
+    search_parser = subparsers.add_parser("search", help="search indexed clones")
+    search_parser.add_argument("term", help="Term (not a regular expression)")
+    search_parser.add_argument("repos", help="owner/repo to search", nargs="*")
+    search_parser.add_argument(
+        "-i", "--ignore-case", help="ignore case", action="store_true"
+    )
+    search_parser.add_argument("--json", help="output json lines", action="store_true")
+    search_parser.set_defaults(func=search_main)
+    args = parser.parse_args()
+    if args.index is None:
+        args.index = os.path.join(args.workdir, "code_index.sqlite")
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
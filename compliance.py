@@ -0,0 +1,84 @@
+"""
+    Compliance status of repositories, as used by the reports
+
+    The status is derived from the default branch's protection data, either
+    from the raw responses or from the details gathered while harvesting. It
+    is stored at collection time in the "repo_status" table, so reports do
+    not need to re-derive it.
+"""
+import collections
+
+STATUS_TABLE = "repo_status"
+# the default branch settings a compliant repo has
+CHECKS = ("protected", "restricted", "enforcement", "signed")
+
+Repo = collections.namedtuple(
+    "Repo", "name mfa protected restricted enforcement signed team_used".split()
+)
+
+
+def get_nested(eventual_obj, *keys, default=None):
+    for key in keys:
+        try:
+            eventual_obj = eventual_obj[key]
+        except (KeyError, TypeError):
+            eventual_obj = default
+    return eventual_obj
+
+
+def derive_status(full_name, mfa, protected, protection, signatures):
+    """
+    Status of a repo
+
+    protection & signatures are the bodies of the default branch's
+    protection and required_signatures responses (None if not available).
+    """
+    # protections apply to admins
+    enforcement = get_nested(protection, "enforce_admins", "enabled", default=False)
+    # limit commits to default
+    num_teams = len(get_nested(protection, "restrictions", "teams", default=[]))
+    num_users = len(get_nested(protection, "restrictions", "users", default=[]))
+    limited_commits = bool(num_teams + num_users > 0)
+    # commits signed comes from signature doc
+    signing_required = get_nested(signatures, "enabled", default=False)
+    # prefer team restrictions
+    team_preferred = num_teams > 0 and num_users == 0
+    # we want owner/repo in lower case to facilitate formatting in
+    # spreadsheets later on.
+    return Repo(
+        full_name.lower(),
+        mfa,
+        protected,
+        limited_commits,
+        enforcement,
+        signing_required,
+        team_preferred,
+    )
+
+
+def status_record(full_name, repo_id, details, mfa):
+    """
+    Document for the status table, from harvest_repo's details
+    """
+    status = derive_status(
+        full_name,
+        mfa,
+        details.get("default_protected", False),
+        details.get("protections"),
+        details.get("signatures"),
+    )
+    record = {
+        "full_name": full_name,
+        "id": repo_id,
+        "default_branch": details.get("default_branch"),
+        "protected_branch_count": details.get("protected_branch_count"),
+    }
+    record.update(status._asdict())
+    return record
+
+
+def status_from_record(record):
+    """
+    Repo from a status table document
+    """
+    return Repo(*(record[field] for field in Repo._fields))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+    Answer compliance queries over HTTP, from the org dbs in a directory
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import compliance
+import db_store
+import report_branch_status
+
+_epilog = """
+Every '{org}.db.json' (or .db.sqlite) file in '--db-dir' is loaded once, and
+reloaded when it changes. An org with both is loaded from the .db.sqlite
+file. With '--services' (the output of 'moz_scripts/get_repos.sh'),
+services can be queried too.
+
+Queries (all answered as json):
+    /repo/{owner}/{repo}    status of the repo
+    /org/{org}              status of the org's repos
+    /service/{service}      status of the service's repos
+    /orgs                   the loaded orgs, with their repo counts
+
+Add '?noncompliant' to the org & service queries to only list the repos
+missing any of: protected restricted enforcement signed
+"""
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+
+def status_doc(status):
+    doc = status._asdict()
+    doc["failing"] = [check for check in compliance.CHECKS if not doc[check]]
+    doc["compliant"] = not doc["failing"]
+    return doc
+
+
+class ComplianceIndex:
+    """
+    Status of every repo in the org dbs of a directory, by org and name
+
+    refresh() reloads the dbs (and services file) which changed since the
+    last refresh. A reloaded org replaces the old one in a single
+    assignment, so queries never see a partly loaded org.
+    """
+
+    def __init__(self, db_dir, services_file=None):
+        self.db_dir = db_dir
+        self.services_file = services_file
+        # {org: {owner/repo: status doc}}, names in lower case
+        self.orgs = {}
+        self.services = {}
+        # size & mtime of each loaded file
+        self.loaded = {}
+        self.db_files = {}
+        self.lock = threading.Lock()
+
+    def file_stat(self, path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def load_org(self, db_file):
+        repos = {}
+        for record in report_branch_status.load_status_records(db_file):
+            status = compliance.status_from_record(record)
+            repos[status.name.lower()] = status_doc(status)
+        return repos
+
+    def refresh(self):
+        with self.lock:
+            orgs = {
+                org.lower(): db_file
+                for org, db_file in db_store.org_db_files(self.db_dir).items()
+            }
+            for db_file in set(self.db_files) - set(orgs.values()):
+                org = self.db_files.pop(db_file)
+                logger.info("Dropping %s", org)
+                self.orgs = {k: v for k, v in self.orgs.items() if k != org}
+                del self.loaded[db_file]
+            for org, db_file in sorted(orgs.items()):
+                try:
+                    stat = self.file_stat(db_file)
+                    if self.loaded.get(db_file) == stat:
+                        continue
+                    start = time.time()
+                    repos = self.load_org(db_file)
+                except (OSError, ValueError) as e:
+                    # maybe still being written, try again next time
+                    logger.warning("Can't load %s: %s", db_file, e)
+                    continue
+                self.orgs = dict(self.orgs, **{org: repos})
+                self.loaded[db_file] = stat
+                self.db_files[db_file] = org
+                logger.info(
+                    "Loaded %d repos of %s in %.2fs",
+                    len(repos),
+                    org,
+                    time.time() - start,
+                )
+            if self.services_file:
+                stat = self.file_stat(self.services_file)
+                if self.loaded.get(self.services_file) != stat:
+                    with open(self.services_file) as f:
+                        self.services = report_branch_status.read_services(f)
+                    self.loaded[self.services_file] = stat
+                    logger.info("Loaded %d services", len(self.services))
+
+    def repo(self, full_name):
+        full_name = full_name.lower()
+        owner = full_name.split("/", 1)[0]
+        return self.orgs.get(owner, {}).get(full_name)
+
+    def org(self, org):
+        repos = self.orgs.get(org.lower())
+        return None if repos is None else list(repos.values())
+
+    def service(self, service):
+        repo_names = self.services.get(service)
+        if repo_names is None:
+            return None
+        return [
+            self.repo(name) or {"name": name.lower(), "missing": True}
+            for name in repo_names
+        ]
+
+    def summary(self):
+        return {
+            org: {
+                "repos": len(repos),
+                "compliant": sum(1 for r in repos.values() if r["compliant"]),
+            }
+            for org, repos in self.orgs.items()
+        }
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, so a client's queries don't each pay for a connection
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # set by main()
+    index = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        kind, _, name = urllib.parse.unquote(url.path).strip("/").partition("/")
+        if kind == "repo":
+            result = self.index.repo(name)
+        elif kind == "org":
+            result = self.index.org(name)
+        elif kind == "service":
+            result = self.index.service(name)
+        elif kind == "orgs" and not name:
+            result = self.index.summary()
+        else:
+            return self.send_json(400, {"error": f"Unknown query {url.path}"})
+        if result is None:
+            return self.send_json(404, {"error": f"No {kind} '{name}'"})
+        if "noncompliant" in query and isinstance(result, list):
+            result = [r for r in result if not r.get("compliant")]
+        self.send_json(200, result)
+
+    def send_json(self, code, result):
+        body = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def refresh_loop(index, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            index.refresh()
+        except Exception:
+            logger.exception("Refresh failed")
+
+
+def main(driver=None):
+    args = parse_args()
+    index = ComplianceIndex(args.db_dir, args.services)
+    index.refresh()
+    QueryHandler.index = index
+    threading.Thread(
+        target=refresh_loop, args=(index, args.interval), daemon=True
+    ).start()
+    server = ThreadingHTTPServer((args.bind, args.port), QueryHandler)
+    logger.info("Listening on %s:%d", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    parser.add_argument(
+        "--db-dir", help="directory with the '{org}.db.json' files", default="."
+    )
+    parser.add_argument("--services", help="get_repos.sh output file")
+    parser.add_argument(
+        "--bind", help="address to listen on (default localhost)", default="127.0.0.1"
+    )
+    parser.add_argument("--port", help="port (default 8080)", type=int, default=8080)
+    parser.add_argument(
+        "--interval",
+        help="seconds between checks for changed files (default 10)",
+        type=float,
+        default=10,
+    )
+    args = parser.parse_args()
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
@@ -0,0 +1,367 @@
+"""
+    Storage backends for the local cache of GitHub API responses
+
+    Documents are kept in named tables. The response cache lives in the
+    "GitHub" table, keyed by the url of the request.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import tinydb
+
+CACHE_TABLE = "GitHub"
+# small tables written ahead of the rest of a json db, so readers which only
+# need them can stop before the responses
+LEADING_TABLES = ("collection_data", "repo_status")
+
+logger = logging.getLogger(__name__)
+
+
+def leading_tables_first(tables):
+    """
+    The table names in tables, reordered to start with LEADING_TABLES
+    """
+    return [t for t in LEADING_TABLES if t in tables] + [
+        t for t in tables if t not in LEADING_TABLES
+    ]
+
+
+class LeadingTablesJSONStorage(tinydb.storages.JSONStorage):
+    """
+    TinyDB's json storage, writing LEADING_TABLES first
+    """
+
+    def write(self, data):
+        super().write({t: data[t] for t in leading_tables_first(list(data))})
+
+
+class TinyDBStore:
+    """
+    The original storage: a TinyDB (json) file named '{org}.db.json'
+
+    Every lookup is a scan of the table, and every write rewrites the
+    whole file, so this gets slow on large orgs.
+    """
+
+    suffix = ".db.json"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = tinydb.TinyDB(filename, storage=LeadingTablesJSONStorage)
+        # TinyDB is not thread safe
+        self.lock = threading.RLock()
+
+    def get(self, value, table=CACHE_TABLE, key="url"):
+        with self.lock:
+            return self.db.table(table).get(tinydb.where(key) == value)
+
+    def upsert(self, doc, table=CACHE_TABLE, key="url"):
+        with self.lock:
+            self.db.table(table).upsert(doc, tinydb.where(key) == doc[key])
+
+    def insert(self, doc, table):
+        with self.lock:
+            self.db.table(table).insert(doc)
+
+    def remove(self, values, table=CACHE_TABLE, key="url"):
+        with self.lock:
+            self.db.table(table).remove(tinydb.where(key).one_of(list(values)))
+
+    def all(self, table=CACHE_TABLE):
+        with self.lock:
+            return self.db.table(table).all()
+
+    def documents(self, table=CACHE_TABLE):
+        # the whole file is in memory anyway
+        return iter(self.all(table))
+
+    def purge(self, table):
+        with self.lock:
+            self.db.purge_table(table)
+
+    def flush(self):
+        # every write already went to disk
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SqliteStore:
+    """
+    SQLite storage in a file named '{org}.db.sqlite'
+
+    Documents are indexed by (table, key), and writes are batched into
+    transactions of up to batch_size documents. Pending writes are visible
+    to lookups before they are committed.
+    """
+
+    suffix = ".db.sqlite"
+
+    def __init__(self, filename, batch_size=500):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        # pending writes, in order, as (table, key, json)
+        self.pending = []
+        # latest pending document for each (table, key)
+        self.pending_docs = {}
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tbl TEXT NOT NULL,
+                    key TEXT,
+                    doc TEXT NOT NULL,
+                    UNIQUE (tbl, key)
+                )
+                """
+            )
+
+    def get(self, value, table=CACHE_TABLE, key="url"):
+        with self.lock:
+            try:
+                return json.loads(self.pending_docs[(table, value)])
+            except KeyError:
+                pass
+            row = self.conn.execute(
+                "SELECT doc FROM documents WHERE tbl = ? AND key = ?", (table, value)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def upsert(self, doc, table=CACHE_TABLE, key="url"):
+        # like TinyDB, update the fields of an existing document
+        with self.lock:
+            existing = self.get(doc[key], table, key)
+            if existing:
+                existing.update(doc)
+                doc = existing
+            self._write(table, doc[key], doc)
+
+    def insert(self, doc, table):
+        # NULL keys never conflict, so this always adds a new row
+        self._write(table, None, doc)
+
+    def remove(self, values, table=CACHE_TABLE, key="url"):
+        """
+        Remove the documents whose key is one of values
+        """
+        with self.lock:
+            self.flush()
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM documents WHERE tbl = ? AND key = ?",
+                    ((table, value) for value in values),
+                )
+
+    def all(self, table=CACHE_TABLE):
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute(
+                "SELECT doc FROM documents WHERE tbl = ? ORDER BY id", (table,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def documents(self, table=CACHE_TABLE):
+        """
+        Generator of the documents in table, without loading them all
+        """
+        with self.lock:
+            self.flush()
+            # a separate cursor, so other calls can be made meanwhile
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT doc FROM documents WHERE tbl = ? ORDER BY id", (table,)
+            )
+        for row in cursor:
+            yield json.loads(row[0])
+
+    def purge(self, table):
+        """
+        Remove every document in table
+        """
+        with self.lock:
+            self.flush()
+            with self.conn:
+                self.conn.execute("DELETE FROM documents WHERE tbl = ?", (table,))
+
+    def tables(self):
+        """
+        Names of all tables, in order of first use
+        """
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute(
+                "SELECT tbl FROM documents GROUP BY tbl ORDER BY min(id)"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _write(self, table, key, doc):
+        text = json.dumps(doc)
+        with self.lock:
+            self.pending.append((table, key, text))
+            if key is not None:
+                self.pending_docs[(table, key)] = text
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            logger.debug("Writing %d documents to %s", len(self.pending), self.filename)
+            with self.conn:
+                self.conn.executemany(
+                    """
+                    INSERT INTO documents (tbl, key, doc) VALUES (?, ?, ?)
+                    ON CONFLICT (tbl, key) DO UPDATE SET doc = excluded.doc
+                    """,
+                    self.pending,
+                )
+            self.pending = []
+            self.pending_docs = {}
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+
+class JSONDocumentReader:
+    """
+    Incremental reader of a TinyDB json file
+
+    The file is read in chunks, and each document decoded as it is reached,
+    so only one document (not the whole file) is held in memory at a time.
+    """
+
+    def __init__(self, infile, chunk_size=1 << 16):
+        self.infile = infile
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """
+        Read more of the file, returning False at end of file
+        """
+        # grow reads with the buffer, so huge documents aren't re-parsed often
+        data = self.infile.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not data:
+            return False
+        self.buffer = self.buffer[self.pos :] + data  # noqa: E203
+        self.pos = 0
+        return True
+
+    def _next_char(self):
+        """
+        Consume whitespace, returning (without consuming) the next character
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        c = self._next_char()
+        if c not in chars or not c:
+            raise ValueError(f"Expected one of {chars!r} at {c!r} in {self.infile}")
+        self.pos += 1
+        return c
+
+    def _value(self):
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # may just be cut off at the end of the buffer
+                if not self._fill():
+                    raise
+                continue
+            self.pos = end
+            return value
+
+    def _members(self):
+        """
+        Generator of the (key, value) pairs of the object starting here
+        """
+        self._expect("{")
+        if self._next_char() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+    def tables(self):
+        """
+        Generator of (table, generator of (doc_id, document)) pairs
+
+        Each table's documents must be consumed before moving on.
+        """
+        if not self._next_char():
+            # TinyDB leaves new dbs empty
+            return
+        for table in self._members():
+            documents = self._documents()
+            yield table, documents
+            # skip whatever the caller didn't consume
+            for _ in documents:
+                pass
+
+    def _documents(self):
+        for doc_id in self._members():
+            yield doc_id, self._value()
+
+
+def iter_json_documents(infile, table=CACHE_TABLE):
+    """
+    Generator of the documents in table of the open TinyDB json file
+    """
+    for name, documents in JSONDocumentReader(infile).tables():
+        if name == table:
+            for _, doc in documents:
+                yield doc
+
+
+STORAGE_CLASSES = {"tinydb": TinyDBStore, "sqlite": SqliteStore}
+
+
+def org_db_files(directory):
+    """
+    {org: path} of the org db files in directory
+
+    An org with both a .db.sqlite file and a .db.json file (its export) gets
+    the .db.sqlite one, which is what the collection wrote.
+    """
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        for cls in (TinyDBStore, SqliteStore):
+            if not name.endswith(cls.suffix):
+                continue
+            org = name[: -len(cls.suffix)]  # noqa: E203
+            if org not in files or cls is SqliteStore:
+                files[org] = os.path.join(directory, name)
+    return files
+
+
+def open_store(org_name, storage="tinydb"):
+    """
+    Open (creating if needed) the store for org_name
+    """
+    cls = STORAGE_CLASSES[storage]
+    return cls(org_name + cls.suffix)
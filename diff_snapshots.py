@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+    Find repositories whose branch protection got worse between two
+    collections
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+
+import compliance
+import db_store
+import report_branch_status
+
+_epilog = """
+OLD and NEW are each an '{org}.db.json' (or '{org}.db.sqlite') file, or a
+directory of them, in which case the files of the same org are compared. An
+org with both files in a directory is read from the '.db.sqlite' one.
+Repos are matched by their GitHub id, so renamed repos are still compared.
+
+A repo has regressed when any of these went from true to false:
+    protected restricted enforcement signed
+
+By default, the 'owner/repo' of each regressed repo is printed, ready for
+'moz_scripts/open_issues.py --id 2'. With '--csv', the checks each repo lost
+are listed too.
+"""
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+
+def record_key(record):
+    # ids survive renames, but old collections may not have one
+    if record.get("id") is not None:
+        return record["id"]
+    return record["full_name"].lower()
+
+
+def diff_records(old_records, new_records):
+    """
+    Generator of (new record, checks lost) for each regressed repo
+    """
+    old = {record_key(record): record for record in old_records}
+    for record in new_records:
+        before = old.get(record_key(record))
+        if before is None:
+            # new repo, nothing to compare with
+            continue
+        lost = [
+            check for check in compliance.CHECKS if before[check] and not record[check]
+        ]
+        if lost:
+            yield record, lost
+
+
+def snapshot_pairs(old, new):
+    """
+    Generator of the (old, new) db files to compare
+    """
+    if not os.path.isdir(new):
+        yield old, new
+        return
+    old_files = db_store.org_db_files(old)
+    for org, new_file in sorted(db_store.org_db_files(new).items()):
+        if org in old_files:
+            yield old_files[org], new_file
+        else:
+            logger.info("No previous snapshot for %s", org)
+
+
+def main(driver=None):
+    args = parse_args()
+    writer = None
+    if args.csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["name", "id", "lost"])
+    for old_file, new_file in snapshot_pairs(args.old, args.new):
+        logger.debug("Comparing %s to %s", old_file, new_file)
+        regressions = diff_records(
+            report_branch_status.load_status_records(old_file),
+            report_branch_status.load_status_records(new_file),
+        )
+        for record, lost in regressions:
+            if writer:
+                writer.writerow([record["name"], record["id"], " ".join(lost)])
+            else:
+                print(record["full_name"])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    parser.add_argument("old", help="earlier snapshot (file or directory)")
+    parser.add_argument("new", help="later snapshot (file or directory)")
+    parser.add_argument(
+        "--csv", help="csv output, with the checks lost", action="store_true"
+    )
+    args = parser.parse_args()
+    if os.path.isdir(args.old) != os.path.isdir(args.new):
+        parser.error("Both snapshots must be files, or both directories")
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
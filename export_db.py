@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+    Export collected data to other formats
+"""
+import argparse
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+
+import db_store
+
+_epilog = """
+Subcommands:
+    tinydb  convert '{org}.db.sqlite' files (from 'get_branch_protections.py
+            --storage sqlite') into the '{org}.db.json' layout read by
+            report_branch_status.py and the s3_prep Makefile target.
+    athena  write the dated, gzipped NDJSON files loaded into Athena, in one
+            pass over each db. For '{org}.db.json', these are:
+                {date}-{org}.db.json.gz      every document, plus 'date'
+                {date}-{org}.db.obj.json.gz  those with an object body
+                {date}-{org}.db.arr.json.gz  those with an array body
+            With '--parquet', '{date}-{org}.db.parquet' is also written
+            (bodies as json strings). That requires pyarrow.
+"""
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+
+def export_tinydb(store, outfile):
+    """
+    Write every table of store in TinyDB's json layout
+
+    Documents are written one at a time, so the whole db is never held as
+    a single json string.
+    """
+    # TinyDB always has a (here empty) default table
+    tables = ["_default"] + db_store.leading_tables_first(
+        [t for t in store.tables() if t != "_default"]
+    )
+    outfile.write("{")
+    for t, table in enumerate(tables):
+        if t:
+            outfile.write(", ")
+        outfile.write("{}: {{".format(json.dumps(table)))
+        for doc_id, doc in enumerate(store.documents(table), start=1):
+            if doc_id > 1:
+                outfile.write(", ")
+            outfile.write('"{}": {}'.format(doc_id, json.dumps(doc)))
+        outfile.write("}")
+    outfile.write("}")
+
+
+def tinydb_main(args):
+    sqlite_suffix = db_store.SqliteStore.suffix
+    for db_file in args.db_files:
+        if not db_file.endswith(sqlite_suffix):
+            logger.error("Skipping '%s', not a %s file", db_file, sqlite_suffix)
+            continue
+        org = os.path.basename(db_file)[: -len(sqlite_suffix)]
+        out_name = os.path.join(args.outdir, org + db_store.TinyDBStore.suffix)
+        logger.info("Exporting %s to %s", db_file, out_name)
+        store = db_store.SqliteStore(db_file)
+        try:
+            with open(out_name, "w") as outfile:
+                export_tinydb(store, outfile)
+        finally:
+            store.close()
+
+
+def open_documents(db_file):
+    """
+    Generator of the GitHub table documents of a .db.json or .db.sqlite file
+    """
+    if db_file.endswith(db_store.SqliteStore.suffix):
+        store = db_store.SqliteStore(db_file)
+        try:
+            yield from store.documents()
+        finally:
+            store.close()
+    else:
+        with open(db_file) as infile:
+            yield from db_store.iter_json_documents(infile)
+
+
+class ParquetWriter:
+    """
+    Write documents to parquet in batches, with the body as a json string
+    """
+
+    def __init__(self, filename, batch_size=1000):
+        # optional dependency, only needed for this
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [
+                ("url", pyarrow.string()),
+                ("rc", pyarrow.int64()),
+                ("when", pyarrow.string()),
+                ("body", pyarrow.string()),
+                ("date", pyarrow.string()),
+            ]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def write(self, doc):
+        self.rows.append(
+            {
+                "url": doc.get("url"),
+                "rc": doc.get("rc"),
+                "when": json.dumps(doc.get("when")),
+                "body": json.dumps(doc.get("body")),
+                "date": doc.get("date"),
+            }
+        )
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            table = self.pyarrow.Table.from_pylist(self.rows, schema=self.schema)
+            self.writer.write_table(table)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def export_athena(db_file, outdir, date, parquet=False):
+    """
+    Write the Athena files for one db, returning {file name: documents}
+    """
+    base = os.path.basename(db_file)
+    for suffix in (db_store.TinyDBStore.suffix, db_store.SqliteStore.suffix):
+        if base.endswith(suffix):
+            base = base[: -len(suffix)]
+    prefix = os.path.join(outdir, f"{date}-{base}.db")
+    # (file, test for the documents it gets)
+    partitions = [
+        (f"{prefix}.json.gz", lambda body: True),
+        (f"{prefix}.obj.json.gz", lambda body: isinstance(body, dict)),
+        (f"{prefix}.arr.json.gz", lambda body: isinstance(body, list)),
+    ]
+    counts = {name: 0 for name, _ in partitions}
+    outfiles = [gzip.open(name, "wt", encoding="utf-8") for name, _ in partitions]
+    writer = ParquetWriter(f"{prefix}.parquet") if parquet else None
+    try:
+        for doc in open_documents(db_file):
+            doc = dict(doc, date=date)
+            # same layout as 'jq -c'
+            line = json.dumps(doc, separators=(",", ":"), ensure_ascii=False) + "\n"
+            for (name, wanted), outfile in zip(partitions, outfiles):
+                if wanted(doc.get("body")):
+                    outfile.write(line)
+                    counts[name] += 1
+            if writer:
+                writer.write(doc)
+    finally:
+        for outfile in outfiles:
+            outfile.close()
+        if writer:
+            writer.close()
+    return counts
+
+
+def athena_main(args):
+    if args.parquet:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logger.error("--parquet needs pyarrow installed")
+            return 1
+    os.makedirs(args.outdir, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(
+                export_athena, db_file, args.outdir, args.date, args.parquet
+            ): db_file
+            for db_file in args.db_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            for name, count in sorted(future.result().items()):
+                logger.info("%7d documents in %s", count, name)
+
+
+def main(driver=None):
+    args = parse_args()
+    return args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    tinydb_parser = subparsers.add_parser(
+        "tinydb", help="convert sqlite dbs to '{org}.db.json'"
+    )
+    tinydb_parser.add_argument("db_files", help="'{org}.db.sqlite' files", nargs="+")
+    tinydb_parser.add_argument(
+        "--outdir", help="directory for output (default .)", default="."
+    )
+    tinydb_parser.set_defaults(func=tinydb_main)
+    athena_parser = subparsers.add_parser(
+        "athena", help="write the gzipped NDJSON files for Athena"
+    )
+    athena_parser.add_argument(
+        "db_files", help="'{org}.db.json' (or .db.sqlite) files", nargs="+"
+    )
+    athena_parser.add_argument(
+        "--outdir", help="directory for output (default .)", default="."
+    )
+    athena_parser.add_argument(
+        "--date",
+        help="date to add to the documents (default today, UTC)",
+        default=datetime.datetime.now(datetime.timezone.utc).date().isoformat(),
+    )
+    athena_parser.add_argument(
+        "--parquet", help="also write parquet files", action="store_true"
+    )
+    athena_parser.add_argument(
+        "--jobs", help="dbs to export in parallel (default #cpus)", type=int
+    )
+    athena_parser.set_defaults(func=athena_main)
+    args = parser.parse_args()
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
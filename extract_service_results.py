@@ -3,16 +3,28 @@
     join the service name with the score for the repositories it uses
     and output as csv
 """
-_epilog = """ """
+_epilog = """
+Status comes from the csv output of 'report_branch_status.py', or from the
+stored status of '{org}.db.json' files. Repos are matched ignoring case, so
+status from any number of orgs can be given.
+
+The services are either json lines of '[service, repo_url]' ('--services'),
+or the service metadata files ('{service}.json', listing the service's
+repo urls as "sourceControl") in '--metadata-dir'. All rows are written to
+stdout and, with '--outdir', each service's rows to '{service}.csv' there.
+"""
 import argparse  # noqa: E402
 import collections  # noqa: E402
 import csv  # noqa: E402
-import fileinput  # noqa: E402
 import json  # noqa: E402
 import logging  # noqa: E402
+import os  # noqa: E402
 import sys  # noqa: E402
 import urllib.parse  # noqa: E402
 
+import compliance  # noqa: E402
+import db_store  # noqa: E402
+
 # import tinydb  # noqa: E402
 
 DEBUG = False
@@ -31,14 +43,7 @@ Repo = collections.namedtuple(
 
 
 def report_repos(repo_dict):
-    def get_nested(eventual_obj, *keys, default=None):
-        for key in keys:
-            try:
-                eventual_obj = eventual_obj[key]
-            except (KeyError, TypeError):
-                eventual_obj = default
-        return eventual_obj
-
+    get_nested = compliance.get_nested
     report = []
     for name, info in ((k, v) for k, v in repo_dict.items() if "/" in k):
         protected = get_nested(info, "default_protected", default=False)
@@ -73,14 +78,86 @@ def report_repos(repo_dict):
     # print(report)
 
 
+def load_db_status(db_file):
+    """
+    Status rows from the repo_status table of an org db, as in the csv files
+    """
+    if db_file.endswith(db_store.SqliteStore.suffix):
+        store = db_store.SqliteStore(db_file)
+        try:
+            records = store.all(table=compliance.STATUS_TABLE)
+        finally:
+            store.close()
+    else:
+        with open(db_file) as infile:
+            records = list(
+                db_store.iter_json_documents(infile, table=compliance.STATUS_TABLE)
+            )
+    all_status = {}
+    for record in records:
+        repo_full_name, *status = compliance.status_from_record(record)
+        all_status[repo_full_name.lower()] = [str(x) for x in status]
+    return all_status
+
+
+def load_csv_status(csv_file):
+    """
+    Status rows from a 'report_branch_status.py' csv file
+    """
+    all_status = {}
+    with open(csv_file, newline="") as f:
+        for row in csv.reader(f):
+            if not row or "/" not in row[0]:
+                # blank, header, or service name line
+                continue
+            repo_full_name, *status = row
+            all_status[repo_full_name.lower()] = status
+    return all_status
+
+
 def load_status(files):
+    """
+    Index of status rows by lower case owner/repo, from all files
+    """
     all_status = {}
-    for line in fileinput.input(files, mode="r"):
-        repo_full_name, *status = line.strip().split(",")
-        all_status[repo_full_name] = status
+    db_suffixes = (db_store.TinyDBStore.suffix, db_store.SqliteStore.suffix)
+    for status_file in files:
+        if status_file.endswith(db_suffixes):
+            all_status.update(load_db_status(status_file))
+        else:
+            all_status.update(load_csv_status(status_file))
     return all_status
 
 
+def read_service_lines(lines):
+    """
+    Generator of (service, repo url) from json lines
+    """
+    for line in lines:
+        logger.debug("line: '{}'".format(line.strip()))
+        if line.strip():
+            service_name, repo_url = json.loads(line)
+            yield service_name, repo_url
+
+
+def read_metadata_dir(metadata_dir):
+    """
+    Generator of (service, repo url) from a directory of service metadata
+    """
+    for name in sorted(os.listdir(metadata_dir)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(metadata_dir, name)) as f:
+            try:
+                metadata = json.load(f)
+            except ValueError as e:
+                logger.warning("Skipping {}: {}".format(name, e))
+                continue
+        service_name = name[: -len(".json")]
+        for repo_url in metadata.get("sourceControl") or []:
+            yield service_name, repo_url
+
+
 def full_name_from_url(url):
     parts = urllib.parse.urlparse(url)
     # parts.path has leading '/', so first element is empty
@@ -91,27 +168,62 @@ def full_name_from_url(url):
     return "{}/{}".format(owner, repo)
 
 
-def main(driver=None):
-    args = parse_args()
-    status_reports = load_status(args.csv_files)
-    for line in args.services.readlines():
-        logger.debug("line: '{}'".format(line.strip()))
-        service_name, repo_url = json.loads(line)
-        full_name = full_name_from_url(repo_url)
+def join_services(services, status_reports):
+    """
+    Generator of a row per (service, repo), with the repo's status
+    """
+    seen = set()
+    for service_name, repo_url in services:
+        # lowercase for ease of spreadsheet formatting
+        full_name = full_name_from_url(repo_url).lower()
+        if (service_name, full_name) in seen:
+            # listed with and without '.git'
+            continue
+        seen.add((service_name, full_name))
         row = [service_name, full_name]
         try:
             row.extend(status_reports[full_name])
         except KeyError:
             row.append("Missing data for repo '{}'".format(full_name))
-        print(",".join(row))
+        yield row
+
+
+def main(driver=None):
+    args = parse_args()
+    status_reports = load_status(args.csv_files)
+    if args.metadata_dir:
+        services = read_metadata_dir(args.metadata_dir)
+    else:
+        services = read_service_lines(args.services)
+    writer = csv.writer(sys.stdout)
+    by_service = collections.OrderedDict()
+    for row in join_services(services, status_reports):
+        writer.writerow(row)
+        if args.outdir:
+            by_service.setdefault(row[0], []).append(row[1:])
+    for service_name, rows in by_service.items():
+        with open(os.path.join(args.outdir, f"{service_name}.csv"), "w") as out:
+            out.write(f"{service_name}\n")
+            csv.writer(out).writerows(rows)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, epilog=_epilog)
     parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
     parser.add_argument("--services", help="input json file", type=argparse.FileType())
-    parser.add_argument("csv_files", help="repo status csv files", nargs="+")
+    parser.add_argument(
+        "--metadata-dir", help="directory of service metadata json files"
+    )
+    parser.add_argument("--outdir", help="also write '{service}.csv' files here")
+    parser.add_argument(
+        "csv_files",
+        help="repo status csv files (or '{org}.db.json' files to read their"
+        " stored status)",
+        nargs="+",
+    )
     args = parser.parse_args()
+    if bool(args.services) == bool(args.metadata_dir):
+        parser.error("Specify one of --services or --metadata-dir")
     global DEBUG
     DEBUG = args.debug
     if DEBUG:
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+    Serve recorded GitHub API responses, to run the scripts without GitHub
+"""
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import logging
+import socketserver
+import time
+import urllib.parse
+
+help_epilog = """
+The responses file maps "METHOD /path" (without any query string) to the
+recorded body. List bodies are served in pages, with "next" links, as
+GitHub does. "POST /graphql" maps to the list of recorded pages of a
+query, the first served for a null cursor, each following one for the
+'endCursor' of the page before it.
+
+Every response has an etag, and conditional requests get a 304, so
+repeated runs behave as they do against GitHub. Bodies are gzip compressed
+for clients which accept that.
+
+Point a script at the server with the GITHUB_API_URL environment variable
+(any token in '.credentials' will do), e.g.:
+
+    ./fake_github.py --port 8000 fixtures/graphql_org.json &
+    GITHUB_API_URL=http://localhost:8000 ./get_branch_protections.py --graphql fixture-org
+"""
+
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT = 5000
+DEFAULT_PER_PAGE = 30
+
+
+def end_cursors(body):
+    """
+    Generator of every 'endCursor' in a GraphQL response
+    """
+    if isinstance(body, dict):
+        for key, value in body.items():
+            if key == "endCursor":
+                yield value
+            else:
+                yield from end_cursors(value)
+    elif isinstance(body, list):
+        for value in body:
+            yield from end_cursors(value)
+
+
+def graphql_page(pages, cursor):
+    """
+    The recorded page following cursor
+    """
+    if cursor is None:
+        return pages[0]
+    for before, page in zip(pages, pages[1:]):
+        if cursor in end_cursors(before):
+            return page
+    return {"errors": [{"message": f"No recorded page after cursor {cursor}"}]}
+
+
+def list_page(body, query):
+    """
+    (page of body, next page number or None)
+    """
+    per_page = int(query.get("per_page", [DEFAULT_PER_PAGE])[0])
+    page = int(query.get("page", [1])[0])
+    items = body[(page - 1) * per_page : page * per_page]  # noqa: E203
+    return items, page + 1 if page * per_page < len(body) else None
+
+
+# http.server has one from python 3.7
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class RecordedHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers & body are written separately, don't delay the body
+    disable_nagle_algorithm = True
+    responses = {}
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        body = self.responses.get(f"GET {parts.path}")
+        headers = {}
+        if body is None:
+            return self.reply(404, {"message": "Not Found"}, headers)
+        if isinstance(body, list):
+            body, next_page = list_page(body, query)
+            if next_page:
+                query["page"] = [next_page]
+                next_query = urllib.parse.urlencode(query, doseq=True)
+                next_url = f"http://{self.headers['Host']}{parts.path}?{next_query}"
+                headers["Link"] = f'<{next_url}>; rel="next"'
+        self.reply(200, body, headers)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        pages = self.responses.get(f"POST {self.path}")
+        if pages is None:
+            return self.reply(404, {"message": "Not Found"}, {})
+        cursor = (request.get("variables") or {}).get("cursor")
+        self.reply(200, graphql_page(pages, cursor), {}, resource="graphql")
+
+    def reply(self, code, body, headers, resource="core"):
+        data = json.dumps(body).encode()
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        if code == 200 and self.headers.get("If-None-Match") == etag:
+            code, data = 304, b""
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        headers.update(
+            {
+                "Content-Type": "application/json; charset=utf-8",
+                "Content-Length": str(len(data)),
+                "ETag": etag,
+                "X-RateLimit-Limit": str(RATE_LIMIT),
+                "X-RateLimit-Remaining": str(RATE_LIMIT),
+                "X-RateLimit-Reset": str(int(time.time()) + 3600),
+                "X-RateLimit-Resource": resource,
+            }
+        )
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(responses, bind="localhost", port=0):
+    """
+    Server (not yet started) for responses, port 0 picks a free one
+    """
+    handler = type("Handler", (RecordedHandler,), {"responses": responses})
+    return ThreadingHTTPServer((bind, port), handler)
+
+
+def main(driver=None):
+    args = parse_args()
+    with open(args.responses) as f:
+        responses = json.load(f)
+    server = make_server(responses, args.bind, args.port)
+    logger.info("Serving %s on port %d", args.responses, server.server_port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=help_epilog)
+    parser.add_argument("--debug", help="log every request", action="store_true")
+    parser.add_argument("responses", help="json file of recorded responses")
+    parser.add_argument(
+        "--bind", help="address to listen on (default localhost)", default="localhost"
+    )
+    parser.add_argument(
+        "--port", help="port to listen on (default 8000)", type=int, default=8000
+    )
+    args = parser.parse_args()
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
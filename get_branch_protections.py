@@ -5,49 +5,67 @@
 """
 import argparse
 import backoff
-import copy
+import concurrent.futures
+import heapq
+import itertools
 import json
 import logging
 import os
+import re
 import socket
+import threading
 import time
 
-from agithub.GitHub import GitHub
-import tinydb
+import agithub_utils
+import compliance
+import db_store
 
 help_epilog = """
-Data will stored in a TinyDB (json) file, named '{org}.db.json'.
-
-WARNING: Remove any prior '{org}.db.json' file prior to execution. There is
-         currently a bad bug prevening updating an existing database.
+Data will stored in a TinyDB (json) file, named '{org}.db.json'. With
+'--storage sqlite', it is stored in '{org}.db.sqlite' instead, which is much
+faster for large orgs. Use 'export_db.py tinydb' to convert that to the
+'{org}.db.json' layout used by the other scripts.
+
+An existing db is updated in place. Responses already in it are requested
+conditionally, and unchanged ones (304 Not Modified) are served from the db
+without using any rate limit. Once an org has been harvested completely, the
+responses, details and status of repos no longer in it are dropped.
+
+Repos whose 'pushed_at' and 'updated_at' are unchanged since they were last
+harvested only have their default branch, its protection and signatures
+requested again (which is free if they are unchanged). Their hooks and
+commit activity are not, and their stored protected branch count is reused.
+Hook changes do not update either value, so every repo is harvested in full
+once the last full harvest of the org is older than '--full-refresh-days'.
+
+Progress is checkpointed in the db as repos are harvested. If a run is
+interrupted, '--resume' continues it without harvesting the completed repos
+again, and with any retries that were still pending.
+
+Besides the raw responses, the compliance status of each repo is stored in
+the "repo_status" table, which the reports read.
 """
 
 DEBUG = False
 CREDENTIALS_FILE = ".credentials"
+# table of the details last harvested for each repo
+DETAILS_TABLE = "repo_details"
 
 
 class AG_Exception(Exception):
     pass
 
 
-# TinyDB utility functions
-def db_setup(org_name):
+# Storage utility functions
+def db_setup(org_name, storage="tinydb"):
     """ HACK
     setup db per org as org_name.db
     setup global queries into it
     """
-    db_filename = "{}.db.json".format(org_name)
-    try:
-        file_stat = os.stat(db_filename)
-        if file_stat.st_size > 0:
-            logger.warn("Updating '%s' may not work.", db_filename)
-    except OSError:
-        # okay if file doesn't exist
-        pass
     try:
-        db = tinydb.TinyDB(db_filename)
+        db = db_store.open_store(org_name, storage)
         global last_table
-        last_table = db.table("GitHub")
+        last_table = db
     except Exception:
         # something very bad. provide some info
         logger.error("Can't create/read db for '{}'".format(org_name))
@@ -96,7 +114,7 @@ def ag_call_with_rc(
     func, *args, expected_rc=None, new_only=True, headers=None, no_cache=False, **kwargs
 ):
     """
-    Wrap AGitHub calls with basic error detection and caching in TingDB
+    Wrap AGitHub calls with basic error detection and caching in the db
 
     Not smart, and hides any error information from caller.
     But very convenient. :)
@@ -105,13 +123,12 @@ def ag_call_with_rc(
         headers = {}
     add_media_types(headers)
     last = {}
+    cached = {}
     url = func.keywords["url"]
     doc = {"url": url}
     if new_only and last_table is not None:
-        try:
-            last = last_table.search(tinydb.where("url") == url)[0]["when"]
-        except IndexError:
-            pass
+        cached = last_table.get(url) or {}
+        last = cached.get("when", {})
         # prefer last modified, as more readable, but neither guaranteed
         # https://developer.github.com/v3/#conditional-requests
         if "last-modified" in last:
@@ -138,7 +155,10 @@ def ag_call_with_rc(
     if rc == 200:
         doc["rc"] = rc
         doc["body"] = body
-    elif rc in (202, 204, 304):
+    elif rc == 304:
+        # nothing changed since we stored it
+        body = cached.get("body", [])
+    elif rc in (202, 204):
         logger.debug("can't handle {} for {}, using older data".format(rc, url))
         body = doc.get("body", [])
     # Handle repo rename/removal corner cases
@@ -159,13 +179,14 @@ def ag_call_with_rc(
         # don't throw on this one
         expected_rc.append(rc)
     logger.debug("{} for {}".format(rc, url))
-    if (not no_cache) and new_only and last_table is not None:
+    # a 304 means the stored record is still current, so leave it alone
+    if (not no_cache) and new_only and last_table is not None and rc != 304:
         h = {k.lower(): v for k, v in gh.getheaders()}
         for x in "etag", "last-modified":
             if x in h:
                 last[x] = h[x]
         doc.update({"body": body, "rc": rc, "when": last})
-        last_table.upsert(doc, tinydb.where("url") == url)
+        last_table.upsert(doc)
 
     # Ignore 204s here -- they come up for many "legit" reasons, such as
     # repositories with no code.
@@ -183,36 +204,19 @@ def ag_call_with_rc(
     return rc, body
 
 
-def ag_get_all(func, *orig_args, **orig_kwargs):
+def ag_get_all(func, *args, **kwargs):
     """
     Generator for multi-page GitHub responses
-
-    It hacks the "page" query parameter to each call to get the next page. This
-    is Not a general solution - it does not follow the links in the headers
-    like a good client should.
     """
-    kwargs = copy.deepcopy(orig_kwargs)
-    args = copy.deepcopy(orig_args)
-    kwargs["page"] = 1
-    while True:
-        body = ag_call(func, *args, **kwargs)
-        if len(body) >= 1:
-            for elem in body:
-                yield elem
-        else:
-            break
-        # We don't expect to need to get multiple pages for items we cache in
-        # the db (we don't handle that). So holler if it appears to be that
-        # way, even if only one page is returned.
-        if not orig_kwargs.get("no_cache", False):
-            logger.error(
-                "Logic error: multi page query with db cache"
-                " url: '{}', page {}".format(func.keywords["url"], kwargs["page"])
-            )
-
-        # fix up to get next page, without changing query set
-        kwargs["page"] += 1
-        kwargs["new_only"] = False
+    # We don't expect to need to get multiple pages for items we cache in
+    # the db (we don't handle that). So holler if it appears to be that
+    # way, even if only one page is returned.
+    if not kwargs.get("no_cache", False):
+        logger.error(
+            "Logic error: multi page query with db cache"
+            " url: '{}'".format(func.keywords["url"])
+        )
+    return agithub_utils.ag_get_all(ag_call, func, *args, **kwargs)
 
 
 # JSON support routines
@@ -226,24 +230,9 @@ class BytesEncoder(json.JSONEncoder):
         return self.super(obj)
 
 
-def get_github_client():
-    def get_token():
-        token = ""
-        with open(CREDENTIALS_FILE, "r") as cf:
-            cf.readline()  # skip first line
-            token = cf.readline().strip()
-        return token
-
-    token = get_token()
-    #  gh = github3.login(token=token)
-    gh = GitHub(token=token)
-    gh.generateAuthHeader()
-    return gh
-
-
 def ratelimit_remaining():
-    # just discovered this code is built into agithub.GitHub as of v2.2
-    return gh.client.ratelimit_seconds_remaining()
+    # tracked from the headers of every response, so no API call needed
+    return agithub_utils.governor.remaining()
 
 
 logger = logging.getLogger(__name__)
@@ -261,22 +250,164 @@ gh = None
 last_table = None
 
 
+def method_for_url(url):
+    """
+    Rebuild the agithub get method for a (cached) url
+    """
+    node = gh
+    for segment in url.strip("/").split("/"):
+        node = node[segment]
+    return node.get
+
+
+class Checkpoint:
+    """
+    Durable record of an org harvest's progress, kept in the org's db
+
+    Records which repos are done and which retries are still pending, so an
+    interrupted run can be resumed. As every TinyDB write rewrites the whole
+    file, progress is written as one document per batch_size repos, and
+    when the run stops. With sqlite storage, these are written in the same
+    batches as the responses, so a checkpoint never gets ahead of the data
+    it describes.
+    """
+
+    table = "checkpoint"
+
+    def __init__(self, db, batch_size=50):
+        self.db = db
+        self.batch_size = batch_size
+        self.full_refresh = False
+        self.started_at = None
+        self.completed = set()
+        self.retries = []
+        # progress since the last write
+        self.done = []
+        self.pending_retries = {}
+        self.changed = False
+        self.batches = 0
+        # repos & retries finish on multiple harvest workers
+        self.lock = threading.RLock()
+
+    def _put(self, key, **fields):
+        fields["key"] = key
+        self.db.upsert(fields, table=self.table, key="key")
+
+    def _put_run(self, **fields):
+        self._put(
+            "run", started_at=self.started_at, full_refresh=self.full_refresh, **fields
+        )
+
+    def start(self, full_refresh):
+        """
+        Begin a new run, forgetting any earlier one
+        """
+        self.db.purge(self.table)
+        self.full_refresh = full_refresh
+        self.started_at = time.time()
+        self._put_run()
+
+    def load(self):
+        """
+        Read the progress of an unfinished run, False if there is none
+        """
+        docs = self.db.all(table=self.table)
+        runs = [d for d in docs if d["key"] == "run"]
+        if not runs or runs[0].get("finished"):
+            return False
+        self.full_refresh = runs[0]["full_refresh"]
+        self.started_at = runs[0].get("started_at")
+        batches = sorted(
+            (d for d in docs if d["key"].startswith("batch:")),
+            key=lambda d: d["sequence"],
+        )
+        for batch in batches:
+            self.completed.update(batch["repos"])
+        # each batch has all retries pending at the time
+        self.retries = batches[-1]["retries"] if batches else []
+        self.batches = len(batches)
+        return True
+
+    def repo_done(self, full_name):
+        with self.lock:
+            if full_name in self.completed:
+                # recorded before the resume
+                return
+            self.done.append(full_name)
+            self.changed = True
+            if len(self.done) >= self.batch_size:
+                self.flush()
+
+    def retry_pending(self, url, max_retries, retry):
+        with self.lock:
+            self.pending_retries[url] = {
+                "url": url,
+                "max_retries": max_retries,
+                "retry": retry,
+            }
+            self.changed = True
+
+    def retry_done(self, url):
+        with self.lock:
+            self.pending_retries.pop(url, None)
+            self.changed = True
+
+    def flush(self):
+        """
+        Write the progress made since the last write
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            self.batches += 1
+            self._put(
+                f"batch:{self.batches}",
+                sequence=self.batches,
+                repos=self.done,
+                retries=list(self.pending_retries.values()),
+            )
+            self.done = []
+            self.changed = False
+
+    def finish(self):
+        with self.lock:
+            self.flush()
+            self._put_run(finished=time.time())
+
+
 class DeferredRetryQueue:
     """
     Some data isn't ready on first probe, and will return an HTTP result code
     indicating that. Queue those up for later execution.
 
+    Retries wait in a heap ordered by when they are due. poll() starts any
+    due retries (on the harvest pool, if there is one), so retries are
+    interleaved with harvesting, and retry_waiting() only sleeps until the
+    next retry is due rather than once per queued call.
+
     Can only be used on calls that do not process the body immediately.
     """
 
-    def __init__(self, retry_codes=None):
+    def __init__(self, retry_codes=None, delay=30, max_parallel=8, checkpoint=None):
         try:
             iter(retry_codes)
         except TypeError:
             # add additional context to error
             raise TypeError("Need a list for 'rc_codes'")
         self.retry_codes = retry_codes
+        # for tiny orgs, need to wait significant time, otherwise retrys run
+        # out before data ready. Wait delay * attempt seconds between tries.
+        self.delay = delay
+        self.max_parallel = max_parallel
+        # entries are (due time, sequence, retriable)
         self.queue = []
+        self.sequence = itertools.count()
+        self.in_flight = set()
+        # set while a harvest pool is available to run retries on
+        self.executor = None
+        # calls may be deferred from multiple harvest workers
+        self.lock = threading.Lock()
+        self.checkpoint = checkpoint
 
     def call_with_retry(self, method, *args, **kwargs):
         """
@@ -289,70 +420,122 @@ class DeferredRetryQueue:
             )
             self.add_retry(method)
 
-    def add_retry(self, method, max_retries=5, **kwargs):
+    def add_retry(self, method, max_retries=5, retry=1, **kwargs):
         """
         add a method (url) to retry later
         """
-        retriable = {
-            "method": method,
-            "max_retries": max_retries,
-            "last_time": time.time(),
-        }
-        self.queue.append(retriable)
+        retriable = {"method": method, "max_retries": max_retries, "retry": retry}
+        due = time.time() + self.delay * retry
+        with self.lock:
+            heapq.heappush(self.queue, (due, next(self.sequence), retriable))
+        if self.checkpoint:
+            self.checkpoint.retry_pending(method.keywords["url"], max_retries, retry)
+
+    def retry(self, r):
+        """
+        Retry one call, requeueing it if still not ready
+        """
+        url = r["method"].keywords["url"]
+        # retried data is "best effort", so don't bail on exceptions
+        try:
+            rc, _ = ag_call_with_rc(r["method"], expected_rc=[200, 202])
+        except (AG_Exception, ValueError) as e:
+            logger.error("Fail on retry %s for %s: %s", r["retry"], url, repr(e))
+        else:
+            if rc not in self.retry_codes:
+                logger.info(f"Data retrieved on retry {r['retry']} for {url}")
+            elif r["retry"] < r["max_retries"]:
+                # still not ready
+                self.add_retry(r["method"], r["max_retries"], r["retry"] + 1)
+                return
+            else:
+                logger.warning(f"No data after {r['retry']} retries for {url}")
+        if self.checkpoint:
+            self.checkpoint.retry_done(url)
+
+    def poll(self, executor=None):
+        """
+        Start all retries which are due, without waiting for them
+        """
+        executor = executor or self.executor
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                due.append(heapq.heappop(self.queue)[2])
+        for r in due:
+            if executor:
+                future = executor.submit(self.retry, r)
+                with self.lock:
+                    self.in_flight.add(future)
+            else:
+                self.retry(r)
+        self.reap()
+
+    def reap(self):
+        """
+        Forget finished retries, raising any exception they hit
+        """
+        with self.lock:
+            done = {f for f in self.in_flight if f.done()}
+            self.in_flight -= done
+        for future in done:
+            future.result()
 
     def retry_waiting(self):
         """
-        Walk queue, retry each call, retry again if get 202
+        Run retries until the queue is empty
 
-        If still not successful, return member to queue
+        Retries that come due at the same time run in parallel.
         """
-        needs_retry = self.queue
-        self.queue = []
-        retry = 0
-        while needs_retry:
-            retry += 1
-            remaining = needs_retry
-            needs_retry = []
-            for r in remaining:
-                now = time.time()
-                # for tiny orgs, need to wait significant time,
-                # otherwise retrys run out before data ready
-                not_before = r["last_time"] + (30 * retry)
-                if not_before > now:
-                    nap_seconds = int(not_before - now) + 1
-                    url = r["method"]
-                    logger.info(f"waiting {nap_seconds:d} before retry on {url}")
-                    time.sleep(int(not_before - now) + 1)
-                rc, _ = ag_call_with_rc(r["method"], expected_rc=[200, 202])
-                if rc in self.retry_codes:
-                    # still not ready
-                    if retry < r["max_retries"]:
-                        r["last_time"] = now
-                        needs_retry.append(r)
-                    else:
-                        # put back on queue, since not finished
-                        self.add_retry(**r)
-                        url = r["method"].keywords["url"]
-                        logger.warning(f"No data after {retry} retries for {url}")
-                else:
-                    logger.info(
-                        f"Data retrieved on retry {retry} for {r['method'].keywords['url']}"
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_parallel
+        ) as own_executor:
+            executor = self.executor or own_executor
+            while True:
+                self.poll(executor)
+                with self.lock:
+                    next_due = self.queue[0][0] if self.queue else None
+                    running = list(self.in_flight)
+                if next_due is None and not running:
+                    break
+                timeout = None if next_due is None else max(0, next_due - time.time())
+                if next_due is not None and timeout > 1:
+                    logger.info(f"waiting {timeout:.0f} before next retry")
+                if running:
+                    # a finished retry may have queued another
+                    concurrent.futures.wait(
+                        running,
+                        timeout=timeout,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
                     )
+                else:
+                    time.sleep(timeout)
 
 
-def harvest_repo(repo):
+def harvest_repo(repo, stored=None):
+    """
+    Harvest the data of a repo, returning {owner/repo: details}
+
+    stored is the details of an earlier harvest, if the repo hasn't changed
+    since. Then only the default branch, protection & signatures are
+    requested again, and the stored protected branch count is reused.
+    """
     full_name = repo["full_name"]
     name = repo["name"]
     owner = repo["owner"]
     default_branch = repo["default_branch"]
     logger.debug(f"{full_name} ({default_branch}) started")
-    protected_count = len(
-        list(
-            ag_get_all(
-                gh.repos[full_name].branches.get, protected="true", no_cache=True
+    if stored and "protected_branch_count" in stored:
+        protected_count = stored["protected_branch_count"]
+    else:
+        protected_count = len(
+            list(
+                ag_get_all(
+                    gh.repos[full_name].branches.get, protected="true", no_cache=True
+                )
             )
         )
-    )
     details = {
         "owner": owner,
         "name": name,
@@ -403,19 +586,8 @@ def harvest_repo(repo):
             default_branch,
             json.dumps(signatures, indent=2, cls=BytesEncoder),
         )
-        # just get into database. No other action for now
-        hooks = list(ag_get_all(gh.repos[full_name].hooks.get, no_cache=True))
-        for hook in hooks:
-            ag_call(gh.repos[full_name].hooks[hook["id"]].get)
-        logger.debug("Hooks for %s: %s (%s)", full_name, len(hooks), repr(hooks))
-        # activity metrics are "best effort", so don't bail on
-        # exceptions
-        method = gh.repos[full_name].stats.commit_activity.get
-        try:
-            org_queue.call_with_retry(method, expected_rc=[200, 202])
-        except AG_Exception as e:
-            logger.error("Fail on %s activity: %s", full_name, str(e))
-            # continue on
+        if stored is None:
+            harvest_activity(full_name)
         # the subfields might not have had changes, so don't blindly update
         if branch:
             details.update({"default_protected": bool(branch["protected"])})
@@ -426,31 +598,485 @@ def harvest_repo(repo):
     except AG_Exception:
         # Assume no branch so add no data
         pass
+    last_table.upsert(
+        {"full_name": full_name, "details": details},
+        table=DETAILS_TABLE,
+        key="full_name",
+    )
     return {repo["full_name"]: details}
 
 
-def harvest_org(org_name):
+def harvest_activity(full_name):
+    """
+    Get a repo's hooks & commit activity into the database
+    """
+    # just get into database. No other action for now
+    hooks = list(ag_get_all(gh.repos[full_name].hooks.get, no_cache=True))
+    for hook in hooks:
+        ag_call(gh.repos[full_name].hooks[hook["id"]].get)
+    logger.debug("Hooks for %s: %s (%s)", full_name, len(hooks), repr(hooks))
+    # activity metrics are "best effort", so don't bail on
+    # exceptions
+    method = gh.repos[full_name].stats.commit_activity.get
+    try:
+        org_queue.call_with_retry(method, expected_rc=[200, 202])
+    except AG_Exception as e:
+        logger.error("Fail on %s activity: %s", full_name, str(e))
+        # continue on
+
+
+def record_status(full_name, repo_id, details, mfa):
+    """
+    Store the compliance status of a repo, for the reports to use
+    """
+    last_table.upsert(
+        compliance.status_record(full_name, repo_id, details, mfa),
+        table=compliance.STATUS_TABLE,
+        key="full_name",
+    )
+
+
+def cached_repo_details(repo):
+    """
+    Details from the last harvest of repo, if it hasn't changed since
+
+    The 'pushed_at' & 'updated_at' of the org's repo listing are compared
+    with the stored repo document. Returns None if the repo needs to be
+    harvested in full.
+    """
+    full_name = repo["full_name"]
+    cached = last_table.get(f"/repos/{full_name}") or {}
+    body = cached.get("body")
+    if cached.get("rc") != 200 or not isinstance(body, dict):
+        return None
+    for field in ("pushed_at", "updated_at"):
+        if not repo.get(field) or body.get(field) != repo[field]:
+            return None
+    record = last_table.get(full_name, table=DETAILS_TABLE, key="full_name")
+    if not record:
+        return None
+    return record["details"]
+
+
+def prune_removed_repos(db, org_name, listed):
+    """
+    Drop the repos which are no longer in the org from db
+
+    listed is every owner/repo in the org's repo listing, which must be
+    complete. The responses, details & status of any other repo are
+    removed, so the reports stop showing deleted (or transferred) repos.
+    """
+    if not listed:
+        # more likely a failed listing than an empty org
+        logger.warning("No repos listed for %s, keeping the stored ones", org_name)
+        return
+    repo_url_pat = re.compile(r"^/repos/([^/]+/[^/]+)(/|$)")
+    gone_urls = []
+    gone = set()
+    for doc in db.documents():
+        match = repo_url_pat.match(doc.get("url", ""))
+        if match and match.group(1) not in listed:
+            gone_urls.append(doc["url"])
+            gone.add(match.group(1))
+    for table in (DETAILS_TABLE, compliance.STATUS_TABLE):
+        gone.update(
+            d["full_name"] for d in db.all(table) if d["full_name"] not in listed
+        )
+    if not gone:
+        return
+    logger.info(
+        "Dropping %d repos no longer in %s: %s",
+        len(gone),
+        org_name,
+        " ".join(sorted(gone)),
+    )
+    db.remove(gone_urls)
+    db.remove(gone, table=DETAILS_TABLE, key="full_name")
+    db.remove(gone, table=compliance.STATUS_TABLE, key="full_name")
+
+
+def harvest_org(org_name, workers=1, skip_unchanged=False, checkpoint=None):
+    """
+    Harvest every repo of an org
+
+    returns (dict of repo details by owner/repo, True if the repo listing
+    was complete)
+    """
+
+    def listing_call(func, *args, **kwargs):
+        rc, body = ag_call_with_rc(func, *args, **kwargs)
+        if rc not in (200, 304) or not isinstance(body, list):
+            logger.error("Got %s listing repos of %s", rc, org_name)
+            listing["complete"] = False
+        return body
+
     def repo_fetcher():
         logger.debug("Using API for repos")
-        for repo in ag_get_all(gh.orgs[org_name].repos.get, no_cache=True):
+        for repo in agithub_utils.ag_get_all(
+            listing_call, gh.orgs[org_name].repos.get, no_cache=True
+        ):
+            if isinstance(repo, dict) and "full_name" in repo:
+                yield repo
+
+    def repo_harvester(repo):
+        full_name = repo["full_name"]
+        repo_data = None
+        if checkpoint and full_name in checkpoint.completed:
+            record = last_table.get(full_name, table=DETAILS_TABLE, key="full_name")
+            if record:
+                logger.debug("%s done before resume", full_name)
+                repo_data = {full_name: record["details"]}
+        if repo_data is None:
+            repo_data = repo_harvest(repo)
+        record_status(full_name, repo.get("id"), repo_data[full_name], mfa)
+        if checkpoint:
+            checkpoint.repo_done(full_name)
+        return repo_data
+
+    def repo_harvest(repo):
+        stored = cached_repo_details(repo) if skip_unchanged else None
+        if stored:
+            logger.debug("%s unchanged, only checking protection", repo["full_name"])
+            skipped.append(repo["full_name"])
+        else:
             # TODO: not sure yielding correct 'repo' here
             # hack - we can't cache on get_all, so redo repo query here
             ag_call(gh.repos[repo["full_name"]].get)
-            yield repo
+        return harvest_repo(repo, stored)
 
     logger.debug("Working on org '%s'", org_name)
     org_data = {}
+    skipped = []
+    listing = {"complete": True}
     try:
-        ag_call(gh.orgs[org_name].get)
+        org = ag_call(gh.orgs[org_name].get)
     except AG_Exception:
         logger.error("No such org '%s'", org_name)
-        return org_data
-    for repo in repo_fetcher():
-        repo_data = harvest_repo(repo)
-        org_data.update(repo_data)
+        return org_data, False
+    mfa = compliance.get_nested(org, "two_factor_requirement_enabled", default=False)
+    if workers > 1:
+        logger.info("Harvesting with %d workers", workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            # keep the pool just busy, so due retries don't queue behind
+            # every remaining repo
+            running = set()
+            org_queue.executor = pool
+            try:
+                for repo in repo_fetcher():
+                    running.add(pool.submit(repo_harvester, repo))
+                    if len(running) >= workers:
+                        done, running = concurrent.futures.wait(
+                            running, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            org_data.update(future.result())
+                        org_queue.poll()
+                for future in concurrent.futures.as_completed(running):
+                    org_data.update(future.result())
+                org_queue.retry_waiting()
+            except BaseException:
+                # don't start on any queued repos (e.g. on Ctrl-C)
+                for future in running:
+                    future.cancel()
+                raise
+            finally:
+                org_queue.executor = None
+    else:
+        for repo in repo_fetcher():
+            repo_data = repo_harvester(repo)
+            org_data.update(repo_data)
+            org_queue.poll()
     # process any pending
     org_queue.retry_waiting()
-    return org_data
+    if skip_unchanged:
+        logger.info(
+            "%d of %d repos in %s unchanged", len(skipped), len(org_data), org_name
+        )
+    return org_data, listing["complete"]
+
+
+# GraphQL (API v4) support
+# One query returns everything needed for the compliance report for up to
+# 100 repositories. Nested page sizes keep the query under GitHub's node
+# limit.
+GRAPHQL_ORG_QUERY = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    login
+    requiresTwoFactorAuthentication
+    repositories(first: 100, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        databaseId
+        id
+        name
+        nameWithOwner
+        owner {
+          login
+        }
+        isArchived
+        pushedAt
+        updatedAt
+        defaultBranchRef {
+          name
+          branchProtectionRule {
+            requiresCommitSignatures
+            isAdminEnforced
+            restrictsPushes
+            pushAllowances(first: 100) {
+              nodes {
+                actor {
+                  __typename
+                  ... on App {
+                    slug
+                  }
+                  ... on Team {
+                    slug
+                  }
+                  ... on User {
+                    login
+                  }
+                }
+              }
+            }
+          }
+        }
+        branchProtectionRules(first: 25) {
+          totalCount
+          nodes {
+            matchingRefs(first: 100) {
+              totalCount
+              nodes {
+                name
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def graphql_protection_body(rule):
+    """
+    Build the REST protection response equivalent to a branchProtectionRule
+    """
+    body = {"enforce_admins": {"enabled": bool(rule["isAdminEnforced"])}}
+    if rule["restrictsPushes"]:
+        restrictions = {"users": [], "teams": [], "apps": []}
+        for allowance in rule["pushAllowances"]["nodes"]:
+            actor = allowance["actor"] or {}
+            kind = actor.get("__typename")
+            if kind == "User":
+                restrictions["users"].append({"login": actor["login"]})
+            elif kind == "Team":
+                restrictions["teams"].append({"slug": actor["slug"]})
+            elif kind == "App":
+                restrictions["apps"].append({"slug": actor["slug"]})
+        body["restrictions"] = restrictions
+    return body
+
+
+def graphql_default_branch(node):
+    """
+    Name of the repo's default branch, as REST would give it
+
+    An empty repository has no defaultBranchRef, but REST still names a
+    default branch (which then 404s), so ask REST for it.
+    """
+    ref = node["defaultBranchRef"]
+    if ref:
+        return ref["name"]
+    repo = ag_call(gh.repos[node["nameWithOwner"]].get)
+    return compliance.get_nested(repo, "default_branch")
+
+
+def graphql_repo_docs(node, default_branch):
+    """
+    Translate one repository node into the REST responses it replaces
+
+    Returns a list of (url, rc, body) in the shape ag_call_with_rc caches
+    them, so report_branch_status.py can't tell the difference.
+    """
+    full_name = node["nameWithOwner"]
+    repo_url = f"/repos/{full_name}"
+    ref = node["defaultBranchRef"]
+    repo_body = {
+        "id": node["databaseId"],
+        "node_id": node["id"],
+        "name": node["name"],
+        "full_name": full_name,
+        "owner": {"login": node["owner"]["login"]},
+        "default_branch": default_branch,
+        "archived": node["isArchived"],
+        "pushed_at": node["pushedAt"],
+        "updated_at": node["updatedAt"],
+    }
+    docs = [(repo_url, 200, repo_body)]
+    if not default_branch:
+        return docs
+    branch_url = f"{repo_url}/branches/{default_branch}"
+    if not ref:
+        # empty repository, REST answers 404 for the branch
+        docs.append((branch_url, 404, []))
+        docs.append((f"{branch_url}/protection", 404, []))
+        docs.append((f"{branch_url}/protection/required_signatures", 404, []))
+        return docs
+    rule = ref["branchProtectionRule"]
+    docs.append((branch_url, 200, {"name": ref["name"], "protected": bool(rule)}))
+    if rule:
+        docs.append((f"{branch_url}/protection", 200, graphql_protection_body(rule)))
+        docs.append(
+            (
+                f"{branch_url}/protection/required_signatures",
+                200,
+                {"enabled": bool(rule["requiresCommitSignatures"])},
+            )
+        )
+    else:
+        # REST answers 404 for unprotected branches
+        docs.append((f"{branch_url}/protection", 404, []))
+        docs.append((f"{branch_url}/protection/required_signatures", 404, []))
+    return docs
+
+
+def graphql_protected_branch_count(node):
+    """
+    Number of protected branches of a repository node
+
+    Counted from the rules' matching refs, unless the query didn't return
+    them all, when the protected branches are listed via REST instead.
+    """
+    rules = node["branchProtectionRules"]
+    protected_branches = set()
+    complete = rules["totalCount"] <= len(rules["nodes"])
+    for rule in rules["nodes"]:
+        refs = rule["matchingRefs"]
+        complete = complete and refs["totalCount"] <= len(refs["nodes"])
+        protected_branches.update(r["name"] for r in refs["nodes"])
+    if complete:
+        return len(protected_branches)
+    full_name = node["nameWithOwner"]
+    logger.debug("Listing the protected branches of %s via REST", full_name)
+    return len(
+        list(
+            ag_get_all(
+                gh.repos[full_name].branches.get, protected="true", no_cache=True
+            )
+        )
+    )
+
+
+def graphql_repo_details(node, default_branch):
+    """
+    Build the same per repo details harvest_repo returns
+    """
+    ref = node["defaultBranchRef"]
+    details = {
+        "owner": node["owner"],
+        "name": node["name"],
+        "default_branch": default_branch,
+        "protected_branch_count": graphql_protected_branch_count(node),
+    }
+    if ref:
+        rule = ref["branchProtectionRule"]
+        details["default_protected"] = bool(rule)
+        if rule:
+            details["protections"] = graphql_protection_body(rule)
+            details["signatures"] = {"enabled": bool(rule["requiresCommitSignatures"])}
+    return {node["nameWithOwner"]: details}
+
+
+def cache_graphql_doc(url, rc, body):
+    """
+    Store a translated response
+
+    Repository, branch & org documents only get the fields GraphQL
+    provided updated, so richer data from a REST harvest is kept.
+    """
+    doc = {"url": url, "rc": rc, "body": body, "when": {}}
+    cached = last_table.get(url)
+    partial_doc = not url.endswith(("/protection", "/required_signatures"))
+    if partial_doc and cached and isinstance(cached.get("body"), dict) and rc == 200:
+        merged = dict(cached["body"])
+        merged.update(body)
+        doc.update({"body": merged, "when": cached.get("when", {})})
+    last_table.upsert(doc)
+
+
+def harvest_org_graphql(org_name):
+    """
+    Harvest an org 100 repositories per API call
+
+    returns (dict of repo details by owner/repo, True if every page of
+    repos was read)
+    """
+    logger.debug("Working on org '%s' via GraphQL", org_name)
+    org_data = {}
+    cursor = None
+    complete = False
+    while True:
+        variables = {"org": org_name, "cursor": cursor}
+        body = ag_call(
+            gh.graphql.post,
+            body={"query": GRAPHQL_ORG_QUERY, "variables": variables},
+            no_cache=True,
+        )
+        if not isinstance(body, dict):
+            # access denied or similar, already logged
+            break
+        errors = body.get("errors", [])
+        for error in errors:
+            logger.error("GraphQL error for %s: %s", org_name, error.get("message"))
+        org = (body.get("data") or {}).get("organization")
+        if not org:
+            logger.error("No such org '%s'", org_name)
+            break
+        # null without org admin rights, where REST leaves the field out
+        mfa = bool(org["requiresTwoFactorAuthentication"])
+        cache_graphql_doc(
+            f"/orgs/{org_name}",
+            200,
+            {"login": org["login"], "two_factor_requirement_enabled": mfa},
+        )
+        repositories = org["repositories"]
+        for node in repositories["nodes"]:
+            default_branch = graphql_default_branch(node)
+            for url, rc, repo_body in graphql_repo_docs(node, default_branch):
+                cache_graphql_doc(url, rc, repo_body)
+            repo_data = graphql_repo_details(node, default_branch)
+            full_name = node["nameWithOwner"]
+            record_status(full_name, node["databaseId"], repo_data[full_name], mfa)
+            org_data.update(repo_data)
+        logger.debug("%d repos harvested for %s", len(org_data), org_name)
+        if errors:
+            # the page may be missing repos
+            break
+        if not repositories["pageInfo"]["hasNextPage"]:
+            complete = True
+            break
+        cursor = repositories["pageInfo"]["endCursor"]
+    return org_data, complete
+
+
+def full_refresh_due(db, days):
+    """
+    True if the last full harvest stored in db is more than days old
+    """
+    last_full = max(
+        (
+            doc["meta"]["collected_at"]
+            for doc in db.all(table="collection_data")
+            if doc.get("meta", {}).get("full_refresh")
+        ),
+        default=0,
+    )
+    return time.time() - last_full >= days * 24 * 60 * 60
 
 
 def get_my_orgs():
@@ -473,14 +1099,14 @@ def process_orgs(args=None, collected_as=None):
         orgs = get_my_orgs()
     else:
         orgs = args.orgs
-    file_suffix = ".db.json"
+    file_suffixes = tuple(c.suffix for c in db_store.STORAGE_CLASSES.values())
     results = {}
     for org in orgs:
         # org allowed to be specified as db filename, so strip suffix if there
-        if org.endswith(file_suffix):
-            org = org[: -len(file_suffix)]
+        if org.endswith(file_suffixes):
+            org = org[: org.rindex(".db.")]
             # avoid foot gun of doubled suffixes from prior runs
-            if org.endswith(file_suffix):
+            if org.endswith(file_suffixes):
                 logger.warn("Skipping org {}".format(org))
                 continue
         logger.info(
@@ -489,9 +1115,13 @@ def process_orgs(args=None, collected_as=None):
         global org_queue
         # Accept (assumed transitory) GitHub glitch codes as retry requests
         org_queue = DeferredRetryQueue(retry_codes=[202, 403, 502])
+        full_refresh = False
+        completed = False
+        listed_all = False
+        checkpoint = None
         try:
             db = None
-            db = db_setup(org)
+            db = db_setup(org, storage=args.storage)
             # global branch_results
             # branch_results = db.table('branch_results')
             if args.repo:
@@ -499,17 +1129,70 @@ def process_orgs(args=None, collected_as=None):
                 repo = ag_call(gh.repos[org][args.repo].get)
                 if repo:
                     org_data = harvest_repo(repo)
+                    mfa = compliance.get_nested(
+                        ag_call(gh.orgs[org].get),
+                        "two_factor_requirement_enabled",
+                        default=False,
+                    )
+                    full_name = repo["full_name"]
+                    record_status(full_name, repo["id"], org_data[full_name], mfa)
                 else:
                     logger.fatal(f"no repo {args.repo} in org {org}")
                     raise ValueError
+            elif args.graphql:
+                org_data, listed_all = harvest_org_graphql(org)
             else:
-                org_data = harvest_org(org)
+                checkpoint = Checkpoint(db)
+                org_queue.checkpoint = checkpoint
+                if args.resume and checkpoint.load():
+                    logger.info(
+                        "Resuming %s, %d repos already done",
+                        org,
+                        len(checkpoint.completed),
+                    )
+                    for retry in checkpoint.retries:
+                        org_queue.add_retry(
+                            method_for_url(retry["url"]),
+                            retry["max_retries"],
+                            retry["retry"],
+                        )
+                else:
+                    if args.resume:
+                        logger.info("No unfinished run of %s to resume", org)
+                    checkpoint.start(full_refresh_due(db, args.full_refresh_days))
+                full_refresh = checkpoint.full_refresh
+                if full_refresh:
+                    logger.info("Harvesting every repo in %s", org)
+                org_data, listed_all = harvest_org(
+                    org,
+                    workers=args.workers,
+                    skip_unchanged=not full_refresh,
+                    checkpoint=checkpoint,
+                )
             org_queue.retry_waiting()
+            if listed_all:
+                prune_removed_repos(db, org, org_data)
+            elif not args.repo:
+                logger.warning(
+                    "Repo listing of %s was incomplete, keeping the stored repos", org
+                )
             results.update(org_data)
+            if checkpoint:
+                checkpoint.finish()
+            completed = True
         finally:
+            if checkpoint and not completed:
+                # keep what was done before the interruption
+                checkpoint.flush()
             if db is not None:
-                meta_data = {"collected_as": collected_as, "collected_at": time.time()}
-                db.table("collection_data").insert({"meta": meta_data})
+                meta_data = {
+                    "collected_as": collected_as,
+                    "collected_at": time.time(),
+                    "full_refresh": full_refresh and completed,
+                    # every repo of the org has a repo_status record
+                    "statuses_complete": listed_all and completed,
+                }
+                db.insert({"meta": meta_data}, table="collection_data")
                 db_teardown(db)
     logger.info(
         "Finished gathering branch protection data" " (calls remaining %s).",
@@ -521,7 +1204,7 @@ def process_orgs(args=None, collected_as=None):
 def main(driver=None):
     args = parse_args()
     global gh
-    gh = get_github_client()
+    gh = agithub_utils.get_github_client(CREDENTIALS_FILE)
     body = ag_call(gh.user.get)
     # occasionally see a degenerate body, so handle that case
     collected_as = body.get("login") if isinstance(body, dict) else str(body)
@@ -536,6 +1219,36 @@ def parse_args():
     parser.add_argument("orgs", help="Organization", nargs="*")
     parser.add_argument("--all-orgs", help="Check all orgs", action="store_true")
     parser.add_argument("--repo", help="Only check for this repo")
+    parser.add_argument(
+        "--workers",
+        help="Number of repos to harvest concurrently (default 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--graphql",
+        help="Collect with GraphQL, 100 repos per call (no hooks or activity)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--full-refresh-days",
+        help="Harvest unchanged repos again if the last full harvest is"
+        " older than this (default 7, 0 for always)",
+        type=float,
+        default=7,
+        metavar="DAYS",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue the last run of each org, if it was interrupted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--storage",
+        help="Backend for the response cache (default tinydb)",
+        choices=sorted(db_store.STORAGE_CLASSES),
+        default="tinydb",
+    )
     parser.add_argument(
         "--debug", help="Debug log level and enter pdb on problem", action="store_true"
     )
@@ -546,6 +1259,12 @@ def parse_args():
         parser.error("Can't specify --all-orgs & positional args")
     elif len(args.orgs) == 0 and not args.all_orgs:
         parser.error("Must specify at least one org (or use --all-orgs)")
+    elif args.repo and args.graphql:
+        parser.error("Can't specify --repo with --graphql")
+    elif args.resume and (args.repo or args.graphql):
+        parser.error("Can't specify --resume with --repo or --graphql")
+    elif args.workers < 1:
+        parser.error("--workers must be at least 1")
     global DEBUG
     DEBUG = args.debug
     if DEBUG:
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+    Keep a history of repository compliance status across collections
+"""
+import argparse
+import collections
+import csv
+import datetime
+import logging
+import sqlite3
+import sys
+
+import compliance
+import db_store
+import report_branch_status
+
+_epilog = """
+Subcommands:
+    add     add the status of each repo in '{org}.db.json' (or .db.sqlite)
+            files, as of when they were collected.
+    repo    show every change in the status of a repo (by owner/repo, or id)
+    trend   show the number of compliant repos of an org, per collection
+
+The history is an sqlite file (default 'history.sqlite'). A repo's status
+is only stored when it differs from its previous status, so the history
+stays small, and questions like when a repo lost protection are answered
+from an index.
+"""
+DEBUG = False
+logger = logging.getLogger(__name__)
+
+# status fields kept, in the order shown
+FIELDS = ("protected", "restricted", "enforcement", "signed", "mfa", "team_used")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    org TEXT NOT NULL,
+    collected_at REAL NOT NULL,
+    repo_count INTEGER NOT NULL,
+    PRIMARY KEY (org, collected_at)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    repo_key TEXT NOT NULL,
+    org TEXT NOT NULL,
+    collected_at REAL NOT NULL,
+    full_name TEXT NOT NULL,
+    present INTEGER NOT NULL,
+    protected INTEGER,
+    restricted INTEGER,
+    enforcement INTEGER,
+    signed INTEGER,
+    mfa INTEGER,
+    team_used INTEGER,
+    PRIMARY KEY (repo_key, collected_at)
+);
+CREATE INDEX IF NOT EXISTS changes_org ON changes (org, collected_at);
+CREATE INDEX IF NOT EXISTS changes_name ON changes (lower(full_name));
+"""
+
+
+def open_history(filename):
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def repo_key(record):
+    # ids survive renames, but old collections may not have one
+    if record.get("id") is not None:
+        return str(record["id"])
+    return record["full_name"].lower()
+
+
+def collected_at(db_file):
+    """
+    When the (last) collection in db_file was made
+    """
+    if db_file.endswith(db_store.SqliteStore.suffix):
+        store = db_store.SqliteStore(db_file)
+        try:
+            metas = store.all(table="collection_data")
+        finally:
+            store.close()
+    else:
+        with open(db_file) as infile:
+            metas = list(db_store.iter_json_documents(infile, "collection_data"))
+    times = [compliance.get_nested(m, "meta", "collected_at") for m in metas]
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+
+def latest_status(conn, org):
+    """
+    The last stored change for each repo of org, by repo key
+    """
+    rows = conn.execute(
+        """
+        SELECT c.* FROM changes c JOIN (
+            SELECT repo_key, max(collected_at) AS collected_at
+            FROM changes WHERE org = ? GROUP BY repo_key
+        ) USING (repo_key, collected_at)
+        """,
+        (org,),
+    )
+    return {row["repo_key"]: row for row in rows}
+
+
+def add_snapshot(conn, org, when, records):
+    """
+    Store the status records of one collection of org
+
+    Returns the number of changes stored, None if the collection is not
+    newer than what is already stored.
+    """
+    last_run = conn.execute(
+        "SELECT max(collected_at) FROM runs WHERE org = ?", (org,)
+    ).fetchone()[0]
+    if last_run is not None and when <= last_run:
+        return None
+    previous = latest_status(conn, org)
+    changes = []
+    seen = set()
+    for record in records:
+        key = repo_key(record)
+        seen.add(key)
+        row = (key, org, when, record["full_name"], 1) + tuple(
+            None if record.get(f) is None else int(bool(record[f])) for f in FIELDS
+        )
+        before = previous.get(key)
+        if before is None or tuple(before)[3:] != row[3:]:
+            changes.append(row)
+    for key, before in previous.items():
+        if key not in seen and before["present"]:
+            # gone from the org (deleted, or moved)
+            changes.append(
+                (key, org, when, before["full_name"], 0) + (None,) * len(FIELDS)
+            )
+    with conn:
+        conn.executemany(
+            "INSERT INTO changes VALUES ({})".format(",".join("?" * (5 + len(FIELDS)))),
+            changes,
+        )
+        conn.execute("INSERT INTO runs VALUES (?, ?, ?)", (org, when, len(seen)))
+    return len(changes)
+
+
+def iso_time(when):
+    return datetime.datetime.utcfromtimestamp(when).isoformat(timespec="seconds")
+
+
+def add_main(args):
+    conn = open_history(args.history)
+    suffixes = tuple(c.suffix for c in db_store.STORAGE_CLASSES.values())
+    for db_file in args.db_files:
+        when = args.collected_at or collected_at(db_file)
+        if when is None:
+            logger.error("No collection time in %s, use --collected-at", db_file)
+            continue
+        # '{org}.db.json' -> org
+        org = db_file.rsplit("/", 1)[-1]
+        for suffix in suffixes:
+            if org.endswith(suffix):
+                org = org[: -len(suffix)]
+        records = report_branch_status.load_status_records(db_file)
+        count = add_snapshot(conn, org.lower(), when, records)
+        if count is None:
+            logger.warning(
+                "Skipping %s, history of %s already has %s or later",
+                db_file,
+                org,
+                iso_time(when),
+            )
+        else:
+            logger.info("%d changes from %s (%s)", count, db_file, iso_time(when))
+    conn.close()
+
+
+def repo_main(args):
+    conn = open_history(args.history)
+    keys = [
+        row[0]
+        for row in conn.execute(
+            "SELECT DISTINCT repo_key FROM changes"
+            " WHERE lower(full_name) = lower(?) OR repo_key = ?",
+            (args.repo, args.repo),
+        )
+    ]
+    writer = csv.writer(sys.stdout)
+    writer.writerow(("date", "name", "present") + FIELDS)
+    for key in keys:
+        for row in conn.execute(
+            "SELECT * FROM changes WHERE repo_key = ? ORDER BY collected_at", (key,)
+        ):
+            writer.writerow(
+                [iso_time(row["collected_at"]), row["full_name"], row["present"]]
+                + [row[f] for f in FIELDS]
+            )
+
+
+def trend_main(args):
+    conn = open_history(args.history)
+    org = args.org.lower()
+    # replay the changes, counting the status after each run
+    changes = conn.execute(
+        "SELECT * FROM changes WHERE org = ? ORDER BY collected_at", (org,)
+    )
+    pending = next(changes, None)
+    current = {}
+    writer = csv.writer(sys.stdout)
+    writer.writerow(("date", "repos") + compliance.CHECKS)
+    for run in conn.execute(
+        "SELECT * FROM runs WHERE org = ? ORDER BY collected_at", (org,)
+    ).fetchall():
+        while pending is not None and pending["collected_at"] <= run["collected_at"]:
+            current[pending["repo_key"]] = pending
+            pending = next(changes, None)
+        if args.since and run["collected_at"] < args.since:
+            continue
+        counts = collections.Counter()
+        for row in current.values():
+            if row["present"]:
+                counts["repos"] += 1
+                counts.update(f for f in compliance.CHECKS if row[f])
+        writer.writerow(
+            [iso_time(run["collected_at"]), counts["repos"]]
+            + [counts[f] for f in compliance.CHECKS]
+        )
+
+
+def date_arg(value):
+    """
+    Seconds since the epoch for an ISO date (UTC)
+    """
+    date = datetime.datetime.strptime(value, "%Y-%m-%d")
+    return date.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def main(driver=None):
+    args = parse_args()
+    return args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, epilog=_epilog)
+    parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
+    parser.add_argument(
+        "--history", help="history file (default history.sqlite)", default="history.sqlite"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    add_parser = subparsers.add_parser("add", help="add collections to the history")
+    add_parser.add_argument("db_files", help="'{org}.db.json' files", nargs="+")
+    add_parser.add_argument(
+        "--collected-at",
+        help="collection date (YYYY-MM-DD), if not in the db",
+        type=date_arg,
+    )
+    add_parser.set_defaults(func=add_main)
+    repo_parser = subparsers.add_parser("repo", help="status changes of a repo")
+    repo_parser.add_argument("repo", help="owner/repo or repo id")
+    repo_parser.set_defaults(func=repo_main)
+    trend_parser = subparsers.add_parser("trend", help="compliance counts of an org")
+    trend_parser.add_argument("org", help="organization")
+    trend_parser.add_argument(
+        "--since", help="first date (YYYY-MM-DD) to show", type=date_arg
+    )
+    trend_parser.set_defaults(func=trend_main)
+    args = parser.parse_args()
+    global DEBUG
+    DEBUG = args.debug
+    if DEBUG:
+        logger.setLevel(logging.DEBUG)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s"
+    )
+    try:
+        rc = main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        rc = 2
+    raise SystemExit(rc)
@@ -6,14 +6,17 @@ We reopen an issue if it already exists
 """
 
 import argparse
-import copy
 import logging
-import time
+import os
+import sys
 import urllib.parse
 
-from agithub.GitHub import GitHub
 import yaml
 
+# shared helpers live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agithub_utils  # noqa: E402
+
 help_epilog = """
 Uses GitHub's search to find existing issues, then reopens or creates one as
 appropriate.
@@ -92,84 +95,16 @@ def ag_call(
     return body
 
 
-def ag_get_all(func, *orig_args, **orig_kwargs):
+def ag_get_all(func, *args, **kwargs):
     """
     Generator for multi-page GitHub responses
-
-    It hacks the "page" query parameter to each call to get the next page. This
-    is Not a general solution - it does not follow the links in the headers
-    like a good client should.
     """
-    kwargs = copy.deepcopy(orig_kwargs)
-    args = copy.deepcopy(orig_args)
-    kwargs["page"] = 1
-    while True:
-        body = ag_call(func, *args, **kwargs)
-        # search results are ugly
-        if isinstance(body, dict) and "items" in body and len(body["items"]) == 0:
-            break
-        elif not isinstance(body, list):
-            yield body
-        elif len(body) >= 1:
-            for elem in body:
-                yield elem
-        else:
-            break
-
-        # fix up to get next page, without changing query set
-        kwargs["page"] += 1
-        kwargs["new_only"] = False
-
-
-# GitHub API v3 support
-def get_github_client():
-    def get_token():
-        token = ""
-        with open(CREDENTIALS_FILE, "r") as cf:
-            cf.readline()  # skip first line
-            token = cf.readline().strip()
-        return token
-
-    token = get_token()
-    #  gh = github3.login(token=token)
-    gh = GitHub(token=token)
-    gh.generateAuthHeader()
-    return gh
-
-
-def ratelimit_dict():
-    #  return gh.ratelimit_remaining
-    body = ag_call(gh.rate_limit.get, no_cache=True)
-    return body
+    return agithub_utils.ag_get_all(ag_call, func, *args, **kwargs)
 
 
 def ratelimit_remaining():
-    body = ratelimit_dict()
-    return body["resources"]["core"]["remaining"]
-
-
-def wait_for_ratelimit(min_karma=25, msg=None, usingSearch=False):
-    def nap_if_needed(resource, min_karma, msg=None):
-        napped = False
-        if resource["remaining"] < min_karma:
-            now = time.time()
-            nap = max(resource["reset"] - int(now), 0) + 1
-            logger.info("napping for %s seconds", nap)
-            if msg:
-                logger.info(msg)
-            time.sleep(nap)
-            napped = True
-        return napped
-
-    # repeat until good on all channels
-    while gh:
-        payload = ag_call(gh.rate_limit.get, no_cache=True)
-        napped = nap_if_needed(payload["resources"]["core"], min_karma, msg)
-        if usingSearch:
-            napped = nap_if_needed(payload["resources"]["search"], 1, msg) or napped
-
-        if not napped:
-            break
+    # tracked from the headers of every response, so no API call needed
+    return agithub_utils.governor.remaining()
 
 
 # finally, our app!
@@ -216,7 +151,6 @@ def find_existing_issue(owner, repo, term):
     q = term + " is:issue"
     q += " repo:{}/{}".format(owner, repo)
     kwargs = {"q": q}
-    wait_for_ratelimit(usingSearch=True)
     try:
         for body in ag_get_all(gh.search.issues.get, **kwargs):
             if "items" not in body:
@@ -235,7 +169,6 @@ def find_existing_issue(owner, repo, term):
                 state = match["state"]
                 number = match["number"]
                 return number, state
-            wait_for_ratelimit(usingSearch=True)
     except AG_Exception:
         # We assume it's a bad repo, but let other repos process
         pass
@@ -333,8 +266,7 @@ def main(driver=None):
     args = parse_args()
     std_id = args.id
     global gh
-    gh = get_github_client()
-    wait_for_ratelimit(usingSearch=True)
+    gh = agithub_utils.get_github_client(CREDENTIALS_FILE)
     body = ag_call(gh.user.get)
     collected_as = body["login"]
     logger.info(
@@ -345,7 +277,6 @@ def main(driver=None):
     load_messages(args.message_file or MESSAGES_FILE)
     for repo_full_name in args.repos:
         logger.info("Starting on {}".format(repo_full_name))
-        wait_for_ratelimit()
         owner, repo = repo_full_name.split("/")
         # Get message subject
         msg_id = next_message_id(std_id, None)
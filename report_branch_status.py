@@ -5,11 +5,15 @@
 """
 import argparse
 import collections
+import concurrent.futures
 import csv
 import logging
+import os
+import re
 import sys
 
-import tinydb
+import compliance
+import db_store
 
 _help_epilog = """
 Currently checks for the following checkboxes to be enabled on the default
@@ -18,6 +22,17 @@ branch:
     Restrict who can commit to this branch
     Require signed commits
     Include Administrators
+
+The status stored at collection time (the "repo_status" table) is used
+where available, it is only derived from the raw responses for repos
+without one. When the last collection stored the status of every repo, the
+raw responses aren't read at all.
+
+With '--services', the output of 'moz_scripts/get_repos.sh' (a service name
+line, followed by an 'owner/repo' line for each repo it uses) is read
+instead, and a '{service}.csv' report is written to '--outdir' for every
+service. Each '{owner}.db.json' is read just once, and several are read in
+parallel.
 """
 DEBUG = False
 logger = logging.getLogger(__name__)
@@ -29,126 +44,311 @@ Pseudo_code = """
             ouput default branch protection
 """
 
-Repo = collections.namedtuple(
-    "Repo", "name mfa protected restricted enforcement signed team_used".split()
-)
+get_nested = compliance.get_nested
 
 
-def get_nested(eventual_obj, *keys, default=None):
-    for key in keys:
-        try:
-            eventual_obj = eventual_obj[key]
-        except (KeyError, TypeError):
-            eventual_obj = default
-    return eventual_obj
+class DocumentIndex:
+    """
+    The documents of the GitHub table, indexed by url
+
+    Built in a single pass over the table, so every lookup after that is a
+    dict access rather than a scan of the table. Only the org, repo and
+    branch documents the report uses are kept.
+    """
+
+    repo_pat = re.compile(r"^/repos/[^/]+/[^/]+$")
+    report_pat = re.compile(r"^/orgs/[^/]+$|^/repos/[^/]+/[^/]+(/branches/.*)?$")
+
+    def __init__(self, documents):
+        self.by_url = {}
+        self.repos = []
+        self.orgs = {}
+        for doc in documents:
+            url = doc.get("url")
+            # like table.get(), the first document wins
+            if url is None or url in self.by_url or not self.report_pat.match(url):
+                continue
+            self.by_url[url] = doc
+            if self.repo_pat.match(url):
+                self.repos.append(doc)
+
+    def get(self, url):
+        return self.by_url.get(url)
+
+    def org(self, login):
+        """
+        Document for org login, looked up once per owner
+        """
+        if login not in self.orgs:
+            self.orgs[login] = self.get(f"/orgs/{login}")
+        return self.orgs[login]
 
 
 def collect_status(gh, repo_doc):
-    q = tinydb.Query()
     repo_url = repo_doc["url"]
     default_branch = repo_doc["body"]["default_branch"]
     branch_url = f"{repo_url}/branches/{default_branch}"
 
     # mfa status comes from owner
     org = get_nested(repo_doc, "body", "owner", "login")
-    org_url = f"/orgs/{org}"
-    org_doc = gh.get(q.url.matches(org_url))
+    org_doc = gh.org(org)
     mfa = get_nested(org_doc, "body", "two_factor_requirement_enabled", default=False)
 
-    # we want owner/repo in lower case to facilitate formatting in
-    # spreadsheets later on.
-    name = get_nested(repo_doc, "body", "full_name").lower()
-
-    branch_doc = gh.get(q.url.matches(branch_url))
+    branch_doc = gh.get(branch_url)
     protected = get_nested(branch_doc, "body", "protected", default=False)
 
-    # rest come from protection response
+    # rest come from protection & signature responses
     protection_url = f"{branch_url}/protection"
-    protection_doc = gh.get(q.url.matches(protection_url))
-    # protections apply to admins
-    enforcement = get_nested(
-        protection_doc, "body", "enforce_admins", "enabled", default=False
-    )
-    # limit commits to default
-    num_teams = len(
-        get_nested(protection_doc, "body", "restrictions", "teams", default=[])
-    )
-    num_users = len(
-        get_nested(protection_doc, "body", "restrictions", "users", default=[])
-    )
-    limited_commits = bool(num_teams + num_users > 0)
-
-    # commits signed comes from signature doc
-    sig_url = f"{protection_url}/required_signatures"
-    sig_doc = gh.get(q.url.matches(sig_url))
-    signing_required = get_nested(sig_doc, "body", "enabled", default=False)
-    # prefer team restrictions
-    team_preferred = num_teams > 0 and num_users == 0
-    repo = Repo(
-        name,
+    protection_doc = gh.get(protection_url)
+    sig_doc = gh.get(f"{protection_url}/required_signatures")
+    return compliance.derive_status(
+        get_nested(repo_doc, "body", "full_name"),
         mfa,
         protected,
-        limited_commits,
-        enforcement,
-        signing_required,
-        team_preferred,
+        get_nested(protection_doc, "body"),
+        get_nested(sig_doc, "body"),
     )
-    return repo
+
+
+def statuses_complete(metas):
+    """
+    True if the last collection stored the status of every repo
+    """
+    metas = [doc["meta"] for doc in metas if "meta" in doc]
+    if not metas:
+        return False
+    last = max(metas, key=lambda meta: meta.get("collected_at", 0))
+    return bool(last.get("statuses_complete"))
+
+
+def load_db(infile):
+    """
+    Read an org db in a single pass
+
+    returns the DocumentIndex of the GitHub table, and the stored status
+    documents by owner/repo. The DocumentIndex is None if the stored status
+    documents cover every repo, and were read before the GitHub table.
+    """
+    gh = None
+    statuses = None
+    complete = False
+    for table, documents in db_store.JSONDocumentReader(infile).tables():
+        if table == db_store.CACHE_TABLE:
+            if complete and statuses is not None:
+                # leave the responses unread
+                return None, statuses
+            gh = DocumentIndex(doc for _, doc in documents)
+        elif table == compliance.STATUS_TABLE:
+            statuses = {doc["full_name"]: doc for _, doc in documents}
+        elif table == "collection_data":
+            complete = statuses_complete(doc for _, doc in documents)
+    if gh is None and complete and statuses is not None:
+        return None, statuses
+    return gh or DocumentIndex([]), statuses or {}
+
+
+def repo_status(gh, statuses, repo_doc):
+    """
+    Stored status of repo_doc, derived from the responses if there is none
+    """
+    record = statuses.get(get_nested(repo_doc, "body", "full_name"))
+    if record:
+        return compliance.status_from_record(record)
+    return collect_status(gh, repo_doc)
+
+
+def org_rows(infile):
+    """
+    List of (owner/repo, Repo) for every repo in an org db
+    """
+    gh, statuses = load_db(infile)
+    if gh is None:
+        return [
+            (full_name, compliance.status_from_record(record))
+            for full_name, record in statuses.items()
+        ]
+    rows = []
+    for repo in get_repos(gh):
+        full_name = get_nested(repo, "body", "full_name")
+        rows.append((full_name, repo_status(gh, statuses, repo)))
+    return rows
+
+
+def status_records(infile):
+    """
+    Generator of a "repo_status" style record for every repo in an org db
+
+    Records missing from the stored table are derived from the responses.
+    """
+    gh, statuses = load_db(infile)
+    if gh is None:
+        yield from statuses.values()
+        return
+    for repo in get_repos(gh):
+        full_name = get_nested(repo, "body", "full_name")
+        record = statuses.get(full_name)
+        if not record:
+            record = {
+                "full_name": full_name,
+                "id": get_nested(repo, "body", "id"),
+                "default_branch": get_nested(repo, "body", "default_branch"),
+                "protected_branch_count": None,
+            }
+            record.update(collect_status(gh, repo)._asdict())
+        yield record
+
+
+def load_status_records(db_file):
+    """
+    Generator of the "repo_status" records of an org db file
+
+    .db.sqlite files are read with db_store, .db.json files streamed.
+    """
+    if db_file.endswith(db_store.SqliteStore.suffix):
+        store = db_store.SqliteStore(db_file)
+        try:
+            yield from store.documents(table=compliance.STATUS_TABLE)
+        finally:
+            store.close()
+    else:
+        with open(db_file) as infile:
+            yield from status_records(infile)
 
 
 def report_repos(args, report_lines):
     writer = csv.writer(sys.stdout)
     if args.header:
-        writer.writerow(Repo._fields)
+        writer.writerow(compliance.Repo._fields)
     writer.writerows(sorted(report_lines, key=lambda r: r.name))
 
 
-def of_interest(args, repo_document):
+def of_interest(args, repo_name):
     result = True
     if args.only:
-        repo_name = get_nested(repo_document, "body", "full_name")
         result = repo_name in args.only
     return result
 
 
-def get_repos(table):
+def get_repos(index):
     """
-    Generator for all repository documents in table
+    Generator for all repository documents in index
 
     yields document for repo URL query
     """
-    repo_pat = r"^/repos/[^/]+/[^/]+$"
-    q = tinydb.Query()
-    for el in table.search(q.url.matches(repo_pat)):
+    for el in index.repos:
         yield el
 
 
+def read_services(lines):
+    """
+    Parse get_repos.sh output into {service: [owner/repo, ...]}
+    """
+    services = collections.OrderedDict()
+    # repos listed before any service name
+    repos = services.setdefault("BAD", [])
+    for line in lines:
+        line = line.strip()
+        if not line:
+            break
+        elif "/" not in line:
+            # start a fresh service
+            repos = services[line] = []
+        else:
+            repos.append(line)
+    if not services["BAD"]:
+        del services["BAD"]
+    return services
+
+
+def org_status(db_file, only):
+    """
+    Status of the repos named in only, from one org db
+
+    returns dict of Repo by owner/repo (as named in the db)
+    """
+    with open(db_file) as infile:
+        rows = org_rows(infile)
+    return {repo_name: status for repo_name, status in rows if repo_name in only}
+
+
+def report_services(args):
+    services = read_services(args.services)
+    wanted = collections.defaultdict(set)
+    for repos in services.values():
+        for repo_name in repos:
+            wanted[repo_name.split("/")[0]].add(repo_name)
+    db_files = {}
+    for org in wanted:
+        db_file = os.path.join(args.db_dir, f"{org}.db.json")
+        if os.path.isfile(db_file) and os.path.getsize(db_file) > 0:
+            db_files[org] = db_file
+    status = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(org_status, db_file, wanted[org]): org
+            for org, db_file in db_files.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            logger.debug("Finished %s", futures[future])
+            status.update(future.result())
+    for service, repos in services.items():
+        with open(os.path.join(args.outdir, f"{service}.csv"), "w") as out:
+            out.write(f"{service}\n")
+            writer = csv.writer(out)
+            if args.header and repos:
+                writer.writerow(compliance.Repo._fields)
+            for repo_name in repos:
+                org = repo_name.split("/")[0]
+                if org not in db_files:
+                    logger.warning(
+                        "No file for %s (used by %s), skipping", org, service
+                    )
+                    # lowercase for ease of spreadsheet formatting
+                    writer.writerow([repo_name.lower(), "<no_data>"])
+                elif repo_name in status:
+                    writer.writerow(status[repo_name])
+
+
 def main(driver=None):
     args = parse_args()
-    repo_status = []
-    with tinydb.TinyDB(args.infile[0].name) as db:
-        gh = db.table("GitHub")
-        for repo in get_repos(gh):
-            if of_interest(args, repo):
-                status = collect_status(gh, repo)
-                repo_status.append(status)
+    if args.services:
+        return report_services(args)
+    report_lines = []
+    # documents are read one at a time, not the whole file at once
+    for repo_name, status in org_rows(args.infile):
+        if of_interest(args, repo_name):
+            report_lines.append(status)
 
-    report_repos(args, repo_status)
+    report_repos(args, report_lines)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, epilog=_help_epilog)
     parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
     parser.add_argument(
-        "infile",
-        help="input json file",
-        type=argparse.FileType(),
-        nargs=1,
-        default=sys.stdin,
+        "infile", help="input json file", type=argparse.FileType(), nargs="?"
     )
     parser.add_argument("--only", action="append", help="only include these owner/repo")
     parser.add_argument("--header", action="store_true", help="Print CSV headers")
+    parser.add_argument(
+        "--services",
+        help="report on the services listed in this file ('-' for stdin)",
+        type=argparse.FileType(),
+    )
+    parser.add_argument(
+        "--outdir", help="directory for service reports (default .)", default="."
+    )
+    parser.add_argument(
+        "--db-dir", help="directory with the '{org}.db.json' files", default="."
+    )
+    parser.add_argument(
+        "--jobs", help="org files to read in parallel (default #cpus)", type=int
+    )
     args = parser.parse_args()
+    if args.services and (args.infile or args.only):
+        parser.error("Can't specify infile or --only with --services")
+    elif not (args.services or args.infile):
+        parser.error("Must specify infile (or --services)")
     global DEBUG
     DEBUG = args.debug
     if DEBUG:
@@ -3,21 +3,48 @@
     Search for a term in the code of an org or repo, display any hits
 """
 import argparse
-import copy
+import concurrent.futures
 import json
 import logging
 import time
 import urllib.parse
 
-from agithub.GitHub import GitHub
+import agithub_utils
 
 help_epilog = """
 Uses GitHub's search to find candidate repos, then searches for all current
 matches.
+
+Several terms (repeat '--term', or use '--term-file') are OR'd together into
+as few queries as GitHub allows, and the text matches of each hit are used
+to tell which of the terms it was for. With more than one term, each line of
+output is 'term<tab>owner/repo'.
+
+Searches are paced to stay within the search rate limit.
+
+GitHub returns at most 1,000 results for a query. Queries with more are
+split into shards by file size, and if need be by repo (first the repos the
+shard's own results are in, then every other repo of the org), which are
+searched a few at a time.
 """
 
 DEBUG = False
 CREDENTIALS_FILE = ".credentials"
+# limits on a code search query
+#   https://docs.github.com/en/rest/reference/search#limitations-on-query-length
+MAX_QUERY_LENGTH = 256
+MAX_QUERY_OPERATORS = 5
+# ask for the fragments of each file which matched
+TEXT_MATCH_MEDIA_TYPE = "application/vnd.github.v3.text-match+json"
+MAX_RATE_LIMIT_RETRIES = 5
+# most results GitHub returns for a query, and largest file searched
+#   https://docs.github.com/en/rest/reference/search#about-the-search-api
+SEARCH_RESULT_LIMIT = 1000
+MAX_SEARCHED_FILE_SIZE = 384 * 1024
+# shards searched at once, all paced by the search rate limit
+SHARD_WORKERS = 4
+# most repos a shard excludes, before searching every repo of the org
+MAX_EXCLUDED_REPOS = 50
 
 
 class AG_Exception(Exception):
@@ -25,7 +52,15 @@ class AG_Exception(Exception):
 
 
 # agithub utility functions
-def ag_call(
+def ag_call(*args, **kwargs):
+    """
+    Support old calling convention
+    """
+    _, body = ag_call_with_rc(*args, **kwargs)
+    return body
+
+
+def ag_call_with_rc(
     func, *args, expected_rc=None, new_only=True, headers=None, no_cache=False, **kwargs
 ):
     """
@@ -36,7 +71,7 @@ def ag_call(
     """
 
     def query_string():
-        return urllib.parse.quote_plus(kwargs["q"])
+        return urllib.parse.quote_plus(kwargs.get("q", ""))
 
     if not headers:
         headers = {}
@@ -48,6 +83,13 @@ def ag_call(
     if expected_rc is None:
         expected_rc = [200, 304]
     rc, body = func(*args, **kwargs)
+    for _ in range(MAX_RATE_LIMIT_RETRIES):
+        wait = rate_limit_wait(func) if rc == 403 else None
+        if wait is None:
+            break
+        logger.info("Rate limited, retrying in {:.0f} seconds".format(wait))
+        time.sleep(wait)
+        rc, body = func(*args, **kwargs)
     # If we have new information, we want to use it (and store it unless
     # no_cache is true)
     # If we are told our existing info is ok, or there's an error, use the
@@ -60,9 +102,6 @@ def ag_call(
         body = []
     elif rc == 403 and rc not in expected_rc:
         # don't throw on this one, but do show query string
-        # for search, there is a seperate rate limit we don't yet take into
-        # account:
-        #  https://developer.github.com/v3/search/#rate-limit
         logger.error("403 for query string '{}'".format(query_string()))
         logger.error("response: '{}'".format(repr(body)))
         expected_rc.append(rc)
@@ -83,36 +122,33 @@ def ag_call(
         else:
             logger.error("{} for {}".format(rc, url))
             raise AG_Exception
-    return body
+    return rc, body
 
 
-def ag_get_all(func, *orig_args, **orig_kwargs):
+def rate_limit_wait(func):
     """
-    Generator for multi-page GitHub responses
+    Seconds to wait before retrying a 403 response, None if it wasn't
+    because of a rate limit
+
+    Search has its own (small) rate limit, and GitHub may also ask for a
+    pause via Retry-After:
+        https://docs.github.com/en/rest/overview/resources-in-the-rest-api#secondary-rate-limits
+    """
+    # the agithub client the request method is bound to
+    client = func.func.__self__
+    h = {k.lower(): v for k, v in client.headers or []}
+    if "retry-after" in h:
+        return int(h["retry-after"])
+    if h.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in h:
+        return max(int(h["x-ratelimit-reset"]) - time.time(), 0) + 1
+    return None
 
-    It hacks the "page" query parameter to each call to get the next page. This
-    is Not a general solution - it does not follow the links in the headers
-    like a good client should.
-    """
-    kwargs = copy.deepcopy(orig_kwargs)
-    args = copy.deepcopy(orig_args)
-    kwargs["page"] = 1
-    while True:
-        body = ag_call(func, *args, **kwargs)
-        # search results are ugly
-        if isinstance(body, dict) and "items" in body and len(body["items"]) == 0:
-            break
-        elif not isinstance(body, list):
-            yield body
-        elif len(body) >= 1:
-            for elem in body:
-                yield elem
-        else:
-            break
 
-        # fix up to get next page, without changing query set
-        kwargs["page"] += 1
-        kwargs["new_only"] = False
+def ag_get_all(func, *args, **kwargs):
+    """
+    Generator for multi-page GitHub responses
+    """
+    return agithub_utils.ag_get_all(ag_call, func, *args, **kwargs)
 
 
 # JSON support routines
@@ -126,45 +162,9 @@ class BytesEncoder(json.JSONEncoder):
         return self.super(obj)
 
 
-def get_github_client():
-    def get_token():
-        token = ""
-        with open(CREDENTIALS_FILE, "r") as cf:
-            cf.readline()  # skip first line
-            token = cf.readline().strip()
-        return token
-
-    token = get_token()
-    #  gh = github3.login(token=token)
-    gh = GitHub(token=token)
-    gh.generateAuthHeader()
-    return gh
-
-
-def ratelimit_dict():
-    #  return gh.ratelimit_remaining
-    body = ag_call(gh.rate_limit.get, no_cache=True)
-    return body
-
-
-def ratelimit_remaining():
-    body = ratelimit_dict()
-    return body["resources"]["core"]["remaining"]
-
-
-def wait_for_ratelimit(min_karma=25, msg=None):
-    while gh:
-        payload = ag_call(gh.rate_limit.get, no_cache=True)
-        if payload["resources"]["core"]["remaining"] < min_karma:
-            core = payload["resources"]["core"]
-            now = time.time()
-            nap = max(core["reset"] - now, 0.1)
-            logger.info("napping for %s seconds", nap)
-            if msg:
-                logger.info(msg)
-            time.sleep(nap)
-        else:
-            break
+def ratelimit_remaining(resource="core"):
+    # tracked from the headers of every response, so no API call needed
+    return agithub_utils.governor.remaining(resource)
 
 
 logger = logging.getLogger(__name__)
@@ -182,37 +182,240 @@ Pseudo_code = """
 gh = None
 
 
+def quote_term(term):
+    if any(c.isspace() for c in term):
+        return '"{}"'.format(term.replace('"', ""))
+    return term
+
+
+def scope_qualifier(scope):
+    if "/" in scope:
+        return "repo:{}".format(scope)
+    return "user:{}".format(scope)
+
+
+def build_query(terms, qualifiers):
+    return " OR ".join(quote_term(t) for t in terms) + " in:file " + qualifiers
+
+
+def term_batches(terms, qualifiers):
+    """
+    Generator of lists of terms which fit, OR'd together, in one query
+    """
+    batch = []
+    for term in terms:
+        candidate = batch + [term]
+        too_big = len(candidate) > MAX_QUERY_OPERATORS + 1 or (
+            len(build_query(candidate, qualifiers)) > MAX_QUERY_LENGTH
+        )
+        if batch and too_big:
+            yield batch
+            candidate = [term]
+        batch = candidate
+    if batch:
+        yield batch
+
+
+def terms_in_match(match, terms):
+    """
+    Which of terms a code search hit is for, going by its text matches
+    """
+    fragments = " ".join(
+        text_match.get("fragment", "") for text_match in match.get("text_matches", [])
+    ).lower()
+    return [term for term in terms if term.replace('"', "").lower() in fragments]
+
+
+def run_shard(q, truncate=False):
+    """
+    The items of a code search query
+
+    returns (total_count, items), items is only the first page if there are
+    more than GitHub returns, unless truncate is set.
+    """
+    kwargs = {
+        "q": q,
+        "headers": {"Accept": TEXT_MATCH_MEDIA_TYPE},
+        "per_page": agithub_utils.MAX_PER_PAGE,
+    }
+    body = ag_call(gh.search.code.get, **kwargs)
+    if "items" not in body:
+        # 403 or something we don't expect
+        logger.error("Unexpected keys: {}".format(" ".join(body.keys())))
+        return 0, []
+    total = body["total_count"]
+    items = list(body["items"])
+    if total > SEARCH_RESULT_LIMIT and not truncate:
+        return total, items
+    if len(items) < min(total, SEARCH_RESULT_LIMIT):
+        for body in ag_get_all(gh.search.code.get, page=2, **kwargs):
+            if "items" not in body:
+                logger.error("Unexpected keys: {}".format(" ".join(body.keys())))
+                break
+            items.extend(body["items"])
+    logger.debug("{} items for '{}'".format(len(items), q))
+    return total, items
+
+
+# repos of each owner, listed at most once per run
+owner_repo_lists = {}
+
+
+def owner_repos(owner):
+    """
+    The owner/repo of every repo of an org (or user)
+    """
+    if owner not in owner_repo_lists:
+        repos = [r["full_name"] for r in ag_get_all(gh.orgs[owner].repos.get)]
+        if not repos:
+            repos = [r["full_name"] for r in ag_get_all(gh.users[owner].repos.get)]
+        owner_repo_lists[owner] = repos
+    return owner_repo_lists[owner]
+
+
+def split_shard(scope, shard, items):
+    """
+    Shards which together cover a shard, each (qualifier, size, excluded)
+
+    Size ranges are halved (geometrically, as most files are small). A
+    single size of the whole owner is split into a shard for each repo
+    among items (the first page of the shard's results), and the rest of
+    the owner without those repos. Once too many repos are excluded, the
+    rest is split into a shard per remaining repo of the owner. Returns
+    None if the shard can't be split.
+    """
+    qualifier, size, excluded = shard
+    low, high = size or (0, MAX_SEARCHED_FILE_SIZE)
+    if low < high:
+        middle = min(max(low, int(((low + 1) * (high + 1)) ** 0.5) - 1), high - 1)
+        return [
+            (qualifier, (low, middle), excluded),
+            (qualifier, (middle + 1, high), excluded),
+        ]
+    if "/" in scope or qualifier != scope_qualifier(scope):
+        return None
+    hit_repos = sorted(
+        {match["repository"]["full_name"] for match in items} - set(excluded)
+    )
+    if hit_repos and len(excluded) + len(hit_repos) <= MAX_EXCLUDED_REPOS:
+        rest = (qualifier, size, excluded + tuple(hit_repos))
+        return [(scope_qualifier(repo), size, ()) for repo in hit_repos] + [rest]
+    return [
+        (scope_qualifier(repo), size, ())
+        for repo in owner_repos(scope)
+        if repo not in excluded
+    ]
+
+
+def sharded_items(terms, scope):
+    """
+    Generator of the code search items for terms in scope
+
+    Queries with more results than GitHub returns are split into shards,
+    which are searched concurrently.
+    """
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=SHARD_WORKERS)
+    pending = {}
+
+    def submit(qualifier, size, excluded, truncate=False):
+        q = build_query(terms, qualifier)
+        if size:
+            q += " size:{}..{}".format(*size)
+        for repo in excluded:
+            q += " -repo:{}".format(repo)
+        shard = (qualifier, size, excluded)
+        pending[pool.submit(run_shard, q, truncate)] = (shard, truncate)
+
+    try:
+        submit(scope_qualifier(scope), None, ())
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                shard, truncated = pending.pop(future)
+                qualifier = shard[0]
+                total, items = future.result()
+                if truncated or total <= SEARCH_RESULT_LIMIT:
+                    yield from items
+                    continue
+                shards = split_shard(scope, shard, items)
+                if shards is None:
+                    logger.warning(
+                        "Only {} of {} results for {} can be seen".format(
+                            SEARCH_RESULT_LIMIT, total, qualifier
+                        )
+                    )
+                    submit(*shard, truncate=True)
+                    continue
+                logger.debug("Splitting {} results for {}".format(total, qualifier))
+                for shard in shards:
+                    submit(*shard)
+    finally:
+        pool.shutdown(wait=False)
+
+
+def query_matches(terms, scope):
+    """
+    Generator of (repo, terms found) for each hit of a query for terms
+
+    terms found may be empty, when the text matches don't show the term.
+    """
+    for match in sharded_items(terms, scope):
+        repo = match["repository"]["full_name"]
+        if len(terms) == 1:
+            yield repo, terms
+        else:
+            yield repo, terms_in_match(match, terms)
+
+
+def repo_has_term(repo, term):
+    body = ag_call(
+        gh.search.code.get, q=build_query([term], scope_qualifier(repo)), per_page=1
+    )
+    return bool(body.get("total_count"))
+
+
+def term_hits(scopes, terms):
+    """
+    Generator of (term, repo) for each repository containing a term
+    """
+    found = set()
+    for scope in scopes:
+        logger.info("Starting on {}".format(scope))
+        qualifier = scope_qualifier(scope)
+        for batch in term_batches(terms, qualifier):
+            unresolved = set()
+            for repo, hit_terms in query_matches(batch, scope):
+                if not hit_terms:
+                    unresolved.add(repo)
+                for term in hit_terms:
+                    if (term, repo) not in found:
+                        found.add((term, repo))
+                        yield term, repo
+                    else:
+                        logger.debug("another hit for {}".format(repo))
+            # ask about each term not yet found, where some match didn't say
+            # which it was for (other matches in the repo may have)
+            for repo in sorted(unresolved):
+                for term in batch:
+                    if (term, repo) not in found and repo_has_term(repo, term):
+                        found.add((term, repo))
+                        yield term, repo
+
+
 def matching_repos(scope, term):
     """
     Generator for repositories containing term
     """
-    q = term + " in:file"
-    if "/" in scope:
-        q += " repo:{}".format(scope)
-    else:
-        q += " user:{}".format(scope)
-    kwargs = {"q": q}
-    found_repos = set()
-    for body in ag_get_all(gh.search.code.get, **kwargs):
-        if "items" not in body:
-            # 403 or something we don't expect
-            logger.error("Unexpected keys: {}".format(" ".join(body.keys())))
-            break
-        logger.debug("items in body: {}".format(len(body["items"])))
-        for match in body["items"]:
-            repo = match["repository"]["full_name"]
-            if repo not in found_repos:
-                found_repos.add(repo)
-                yield repo
-            else:
-                logger.debug("another hit for {}".format(repo))
+    for _, repo in term_hits([scope], [term]):
+        yield repo
 
 
 def main(driver=None):
     args = parse_args()
     global gh
-    gh = get_github_client()
-    wait_for_ratelimit()
+    gh = agithub_utils.get_github_client(CREDENTIALS_FILE)
     body = ag_call(gh.user.get)
     collected_as = body["login"]
     logger.info(
@@ -220,19 +423,33 @@ def main(driver=None):
             collected_as, ratelimit_remaining()
         )
     )
-    for scope in args.scopes:
-        logger.info("Starting on {}".format(scope))
-        for repo in matching_repos(scope, args.term):
+    for term, repo in term_hits(args.scopes, args.terms):
+        if len(args.terms) > 1:
+            print("{}\t{}".format(term, repo))
+        else:
             print(repo)
-    logger.info("Done with {} API calls remaining".format(ratelimit_remaining()))
+    logger.info(
+        "Done with {} search calls remaining".format(ratelimit_remaining("code_search"))
+    )
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, epilog=help_epilog)
-    parser.add_argument("--term", help="Term to search for", required=True)
+    parser.add_argument(
+        "--term", help="Term to search for (repeatable)", action="append", dest="terms"
+    )
+    parser.add_argument("--term-file", help="file of terms to search for, one per line")
     parser.add_argument("scopes", help="User or User/Repo", default=[], nargs="+")
     parser.add_argument("--debug", help="Enter pdb on problem", action="store_true")
     args = parser.parse_args()
+    args.terms = args.terms or []
+    if args.term_file:
+        with open(args.term_file) as f:
+            args.terms.extend(line.strip() for line in f if line.strip())
+    if not args.terms:
+        parser.error("Must specify a --term (or --term-file)")
+    # keep the order, but search for each term once
+    args.terms = list(dict.fromkeys(args.terms))
     global DEBUG
     DEBUG = args.debug
     if DEBUG: